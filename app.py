@@ -1,17 +1,40 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, send_file, make_response, g, Response
 import json
+import mimetypes
 import os
 import secrets
 import re
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import sqlite3
-import uuid
+import sys
+import threading
+import base64
+from datetime import timedelta
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from itsdangerous import URLSafeTimedSerializer
 import time
+from database import get_pool, reset_pools_after_fork, WalCheckpointer, DB_ERRORS, INTEGRITY_ERRORS, insert_returning_id, primary_key_column, checkpoint_wal
+from cache import make_cache
+from counters import reconcile_counters, reconcile_conversation_unread
+from events import make_event_hub, format_sse
+from hashing import PasswordHasher, HashingBusy, TooManyAttempts
+from images import ImagePipeline
+from media import (UploadTooLarge, save_upload, settle_uploads, discard_staged, acquire_media, release_media,
+                   unreferenced_media, remove_media_files)
+from metrics import Metrics
+from migrations import run_migrations, import_legacy_users, LEGACY_USERS_FILE
+from models import Blog, User, Comment, Notification, load_json_column
+from page_cache import PageCache
+from reset_tokens import (RESET_TOKEN_MINUTES, ResetTokenSweeper, store_reset_token, find_reset_token,
+                          consume_reset_token_row)
+from sitemap_generator import SitemapBuilder, generate_sitemap
+from timeline import TIMELINE_FANOUT_LIMIT, TimelineWorker, add_to_author_timeline, backfill_timeline, remove_author_from_timeline, remove_blog_from_timelines, timeline_page_ids
+from write_behind import WriteBehindBuffer
+from search import init_search_index, index_blog, unindex_blog, search_blogs, highlight_snippet
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
+# Signs password reset links; set SECRET_KEY so links work across workers and restarts
+serializer = URLSafeTimedSerializer(app.secret_key)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 app.config['SESSION_COOKIE_SECURE'] = True  # Always use secure cookies
 app.config['SESSION_COOKIE_HTTPONLY'] = True
@@ -19,10 +42,32 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['UPLOAD_FOLDER'] = os.path.abspath('static/uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Number of reverse proxies in front of the app (Render, nginx) whose
+# X-Forwarded-For/-Proto headers are trusted. Without it every client has the
+# proxy's address, and per-IP limits apply to the whole site at once. Leave
+# at 0 when clients connect directly - they could forge the header.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
 
 
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Uploaded files are served with a one-year immutable Cache-Control.
+# UPLOAD_SENDFILE_MODE=x-sendfile (Apache/lighttpd) or x-accel (nginx, with an
+# internal location at UPLOAD_ACCEL_PREFIX) hands the byte streaming to the
+# front-end server instead of a gunicorn worker.
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+UPLOAD_SENDFILE_MODE = os.environ.get('UPLOAD_SENDFILE_MODE', '').lower()
+UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/_protected_uploads/')
+app.config['USE_X_SENDFILE'] = UPLOAD_SENDFILE_MODE == 'x-sendfile'
+
+# Password hashing runs in a small process pool with per-IP and per-user
+# attempt limits, so a credential-stuffing burst cannot tie up every worker
+password_hasher = PasswordHasher()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -35,22 +80,67 @@ def add_security_headers(response):
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['Content-Security-Policy'] = "frame-ancestors 'none'"
     response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-    # Prevent HTML caching for debugging
-    if response.content_type and 'text/html' in response.content_type:
+    # Personalised HTML must never be stored; anonymous pages served by the
+    # page cache set their own revalidation headers
+    if response.content_type and 'text/html' in response.content_type and 'Cache-Control' not in response.headers:
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     return response
 
-# Database setup
-DB_FILE = 'blog_app.db'
+# Database setup - PostgreSQL when DATABASE_URL is set, SQLite otherwise.
+# Queries use ? placeholders on both; the PostgreSQL cursor translates them.
+db_pool = get_pool()
+
+# Request timing and per-statement query stats, served at /metrics. Counters
+# are per process: with several gunicorn workers each scrape sees one worker.
+# METRICS_ENABLED=0 turns instrumentation off. /metrics exposes SQL text, so
+# it is only served with METRICS_TOKEN set, to "Authorization: Bearer <token>".
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+metrics = Metrics()
+if METRICS_ENABLED:
+    db_pool.instrument = metrics.wrap_connection
+
+@app.before_request
+def start_request_timer():
+    if METRICS_ENABLED:
+        metrics.start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    if METRICS_ENABLED:
+        # Unmatched URLs share one label so 404 probes cannot grow the registry
+        metrics.end_request(request.method, request.endpoint or 'unmatched', response.status_code)
+    return response
+
+def get_db():
+    """Return the connection checked out for the current request"""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Full-page cache for logged-out visitors. Use PAGE_CACHE_BACKEND=filesystem
+# (or redis) so invalidations reach every gunicorn worker; 'none' disables it.
+PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+page_cache = PageCache(None if PAGE_CACHE_BACKEND == 'none' else
+                       make_cache('pages', max_entries=2000,
+                                  default_ttl=int(os.environ.get('PAGE_CACHE_TTL', 300)),
+                                  backend=PAGE_CACHE_BACKEND))
 
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
+        pk = primary_key_column(db_pool.backend)
         
         # Create users table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 username TEXT UNIQUE NOT NULL,
                 email TEXT,
                 password_hash TEXT,
@@ -67,22 +157,22 @@ def init_db():
         ''')
         
         # Create blogs table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS blogs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 title TEXT NOT NULL,
                 content TEXT NOT NULL,
                 author_username TEXT NOT NULL,
                 channel TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                images TEXT DEFAULT "[]"
+                images TEXT DEFAULT '[]'
             )
         ''')
         
         # Create messages table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 sender_username TEXT NOT NULL,
                 receiver_username TEXT NOT NULL,
                 message_text TEXT NOT NULL,
@@ -94,9 +184,9 @@ def init_db():
         ''')
         
         # Create conversations table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 user1_username TEXT NOT NULL,
                 user2_username TEXT NOT NULL,
                 last_message_id INTEGER,
@@ -109,9 +199,9 @@ def init_db():
         ''')
         
         # Create password reset tokens table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS password_reset_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 username TEXT NOT NULL,
                 token_hash TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -122,9 +212,9 @@ def init_db():
         ''')
         
         # Create comments table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 blog_id INTEGER NOT NULL,
                 username TEXT NOT NULL,
                 comment_text TEXT NOT NULL,
@@ -135,9 +225,9 @@ def init_db():
         ''')
         
         # Create follows table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS follows (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 follower_username TEXT NOT NULL,
                 following_username TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -148,9 +238,9 @@ def init_db():
         ''')
         
         # Create notifications table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 user_username TEXT NOT NULL,
                 from_username TEXT NOT NULL,
                 type TEXT NOT NULL,
@@ -165,9 +255,9 @@ def init_db():
         ''')
         
         # Create likes table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS likes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id {pk},
                 blog_id INTEGER NOT NULL,
                 username TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -177,10 +267,32 @@ def init_db():
             )
         ''')
         
+        run_migrations(conn, db_pool.backend)
+        init_search_index(conn, db_pool.backend)
+        
         conn.commit()
 
 init_db()
 
+# Sitemap files are cached on disk and rebuilt per shard after blog writes
+sitemap_builder = SitemapBuilder(os.environ.get('SITEMAP_DIR', os.path.join('instance', 'sitemaps')),
+                                 db_pool.connection, db_pool.backend)
+generate_sitemap(app, sitemap_builder)
+
+def record_image_variants(blog_id, variants):
+    """Store generated image variants on a blog - runs on a pipeline thread"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE blogs SET image_variants = ? WHERE id = ?', (json.dumps(variants), blog_id))
+        cursor.execute('SELECT author_username FROM blogs WHERE id = ?', (blog_id,))
+        result = cursor.fetchone()
+    page_cache.invalidate('feed', f'blog:{blog_id}')
+    if result:
+        page_cache.invalidate(f'user:{result[0]}')
+
+# Resized WebP/AVIF copies of uploads are generated off the request thread
+image_pipeline = ImagePipeline(app.config['UPLOAD_FOLDER'], record_image_variants)
+
 # Security validation functions
 def validate_password(password):
     """Password validation - simplified for better user experience"""
@@ -217,7 +329,7 @@ def sanitize_input(text):
 # Helper functions
 def get_user_security_question(username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT security_question FROM users WHERE username = ?', (username,))
             result = cursor.fetchone()
@@ -226,48 +338,49 @@ def get_user_security_question(username):
         print(f"Error getting security question: {e}")
         return None
 
-def get_user_by_username(username):
+# User rows for profile pages, including misses so scans for random
+# /user/<name> URLs stay off the database. Entries are dropped on this
+# worker when the user changes; other workers catch up within the TTL.
+user_cache = make_cache('users', max_entries=10000, default_ttl=int(os.environ.get('USER_CACHE_TTL', 60)))
+# Misses are kept briefly so a new account shows up on other workers soon
+USER_MISS_TTL = 10
+
+def get_user_by_username(username, use_cache=True):
+    """Return the User record for username, or None.
+    
+    Authentication paths pass use_cache=False so they always see the
+    current password hash.
+    """
+    if use_cache:
+        cached = user_cache.get(username)
+        if cached is not None:
+            # False marks a username known not to exist
+            return cached or None
     try:
-        # First check SQLite database
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-            result = cursor.fetchone()
-    except sqlite3.Error as e:
+            user = User.fetch_one(cursor)
+    except DB_ERRORS as e:
         print(f"Database error in get_user_by_username: {e}")
         return None
     
-    if result:
-        columns = ['id', 'username', 'email', 'password_hash', 'channel', 'created_at', 
-                  'bio', 'profile_pic', 'followers_count', 'following_count', 'posts_count', 'security_question', 'security_answer']
-        return dict(zip(columns, result))
-    
-    # If not found in SQLite, check JSON file for backward compatibility
-    json_file = 'users.json'
-    if os.path.exists(json_file):
-        try:
-            with open(json_file, 'r') as f:
-                users = json.load(f)
-            if username in users:
-                user_data = users[username]
-                return {
-                    'id': None,
-                    'username': username,
-                    'email': user_data.get('email', ''),
-                    'password_hash': user_data.get('password'),
-                    'channel': user_data.get('channel', 'general'),
-                    'created_at': user_data.get('created_at')
-                }
-        except (json.JSONDecodeError, FileNotFoundError):
-            pass
-    
-    return None
+    if user:
+        user_cache.set(username, user)
+    else:
+        user_cache.set(username, False, ttl=USER_MISS_TTL)
+    return user
+
+def invalidate_users(*usernames):
+    """Drop cached user rows after they change"""
+    for username in usernames:
+        user_cache.delete(username)
 
 def create_user(username, email, password_hash, channel, security_question, security_answer):
     try:
         print(f"Creating user - Username: '{username}', Email: '{email}', Channel: '{channel}'")
         
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -275,64 +388,120 @@ def create_user(username, email, password_hash, channel, security_question, secu
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (username, email, password_hash, channel, security_question, security_answer))
             conn.commit()
-            print(f"User '{username}' created successfully in database")
-            return True
-    except sqlite3.IntegrityError as e:
+        invalidate_users(username)
+        print(f"User '{username}' created successfully in database")
+        return True
+    except INTEGRITY_ERRORS as e:
         print(f"User creation failed - duplicate username: {e}")
         return False
-    except sqlite3.Error as e:
+    except DB_ERRORS as e:
         print(f"Database error in create_user: {e}")
         return False
     except Exception as e:
         print(f"Unexpected error in create_user: {e}")
         return False
 
-def get_blogs():
+# Home feed pagination
+FEED_PAGE_SIZE = 20
+
+def encode_feed_cursor(created_at, blog_id):
+    """Encode a (created_at, id) feed position as an opaque URL-safe cursor"""
+    # PostgreSQL returns datetimes; str() gives a literal it compares correctly
+    raw = json.dumps([str(created_at), blog_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_feed_cursor(cursor):
+    """Decode a feed cursor, returning (created_at, id) or None if malformed"""
+    if not cursor:
+        return None
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM blogs ORDER BY created_at DESC')
-            results = cursor.fetchall()
-        
-        blogs = []
-        for row in results:
-            try:
-                # Parse images
-                images = []
-                if row[6]:
-                    try:
-                        images = json.loads(row[6])
-                    except (json.JSONDecodeError, TypeError):
-                        images = []
-                
-                # Get likes count
-                likes_count = get_likes_count(row[0])
-                
-                blog = {
-                    'id': row[0],
-                    'title': row[1],
-                    'content': row[2],
-                    'author': row[3],
-                    'channel': row[4],
-                    'date': row[5],
-                    'images': images,
-                    'likes': likes_count
-                }
-                blogs.append(blog)
-            except Exception as e:
-                print(f"Error processing blog row: {e}")
-                continue
-        return blogs
-    except sqlite3.Error as e:
-        print(f"Database error in get_blogs: {e}")
-        return []
-    except Exception as e:
-        print(f"Unexpected error in get_blogs: {e}")
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, blog_id = json.loads(raw)
+        return str(created_at), int(blog_id)
+    except (ValueError, TypeError):
+        return None
+
+def get_feed_page(cursor=None, limit=FEED_PAGE_SIZE):
+    """Return (blogs, next_cursor) for one page of the home feed, newest first"""
+    position = decode_feed_cursor(cursor)
+    try:
+        with get_db() as conn:
+            cursor_obj = conn.cursor()
+            # Only the first 201 characters of content are needed for the card
+            # excerpt and the "Read More" check in index.html
+            query = '''
+                SELECT b.id, b.title, substr(b.content, 1, 201) AS content, b.author_username, b.channel, b.created_at,
+                       b.images, b.likes_count, b.comments_count, b.image_variants
+                FROM blogs b
+            '''
+            params = []
+            if position:
+                # Row-value form so SQLite and PostgreSQL seek into the index
+                # instead of scanning down to the cursor from the newest row
+                query += ' WHERE (b.created_at, b.id) < (?, ?)'
+                params = [position[0], position[1]]
+            query += ' ORDER BY b.created_at DESC, b.id DESC LIMIT ?'
+            params.append(limit + 1)
+            cursor_obj.execute(query, params)
+            blogs = Blog.fetch_all(cursor_obj)
+    except DB_ERRORS as e:
+        print(f"Database error in get_feed_page: {e}")
+        return [], None
+    
+    next_cursor = None
+    if len(blogs) > limit:
+        blogs = blogs[:limit]
+        next_cursor = encode_feed_cursor(blogs[-1].date, blogs[-1].id)
+    
+    return blogs, next_cursor
+
+def get_following_page(username, cursor=None, limit=FEED_PAGE_SIZE):
+    """Return (blogs, next_cursor) for a user's timeline of followed authors"""
+    position = decode_feed_cursor(cursor)
+    try:
+        with get_db() as conn:
+            cursor_obj = conn.cursor()
+            entries = timeline_page_ids(cursor_obj, username, position, limit)
+            blogs = {}
+            if entries:
+                blog_ids = [blog_id for _, blog_id in entries[:limit]]
+                placeholders = ', '.join('?' for _ in blog_ids)
+                cursor_obj.execute(f'''
+                    SELECT b.id, b.title, substr(b.content, 1, 201) AS content, b.author_username, b.channel,
+                           b.created_at, b.images, b.likes_count, b.comments_count, b.image_variants
+                    FROM blogs b WHERE b.id IN ({placeholders})
+                ''', blog_ids)
+                blogs = {blog.id: blog for blog in Blog.fetch_all(cursor_obj)}
+    except DB_ERRORS as e:
+        print(f"Database error in get_following_page: {e}")
+        return [], None
+    
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_feed_cursor(*entries[-1])
+    
+    return [blogs[blog_id] for _, blog_id in entries if blog_id in blogs], next_cursor
+
+def search_feed(query):
+    """Return ranked, highlighted search results for the index page"""
+    try:
+        with get_db() as conn:
+            blogs = search_blogs(conn, db_pool.backend, query)
+    except DB_ERRORS as e:
+        print(f"Database error in search_feed: {e}")
         return []
+    
+    for blog in blogs:
+        blog.snippet = highlight_snippet(blog.snippet)
+    return blogs
+
+# New posts are copied into followers' timelines in the background
+timeline_worker = TimelineWorker(db_pool.connection)
 
 def create_blog_db(title, content, author, channel):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             
             # Sanitize inputs
@@ -341,22 +510,29 @@ def create_blog_db(title, content, author, channel):
             author = sanitize_input(author)[:50]
             channel = sanitize_input(channel)[:50]
             
-            cursor.execute('''
+            blog_id = insert_returning_id(cursor, db_pool.backend, '''
                 INSERT INTO blogs (title, content, author_username, channel)
                 VALUES (?, ?, ?, ?)
             ''', (title, content, author, channel))
+            index_blog(conn, db_pool.backend, blog_id)
+            add_to_author_timeline(cursor, blog_id)
+            cursor.execute('UPDATE users SET posts_count = posts_count + 1 WHERE username = ?', (author,))
             conn.commit()
-            return True
-    except sqlite3.Error as e:
+        timeline_worker.fan_out(blog_id, author)
+        invalidate_users(author)
+        page_cache.invalidate('feed', f'user:{author}')
+        sitemap_builder.mark_dirty(blog_id)
+        return True
+    except DB_ERRORS as e:
         print(f"Database error in create_blog_db: {e}")
         return False
     except Exception as e:
         print(f"Unexpected error in create_blog_db: {e}")
         return False
 
-def create_blog_with_images(title, content, author, channel, image_urls):
+def create_blog_with_images(title, content, author, channel, image_urls, staged=()):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             
             # Sanitize inputs
@@ -368,13 +544,23 @@ def create_blog_with_images(title, content, author, channel, image_urls):
             # Convert image URLs to JSON
             images_json = json.dumps(image_urls)
             
-            cursor.execute('''
+            blog_id = insert_returning_id(cursor, db_pool.backend, '''
                 INSERT INTO blogs (title, content, author_username, channel, images)
                 VALUES (?, ?, ?, ?, ?)
             ''', (title, content, author, channel, images_json))
+            index_blog(conn, db_pool.backend, blog_id)
+            add_to_author_timeline(cursor, blog_id)
+            acquire_media(cursor, app.config['UPLOAD_FOLDER'], image_urls)
+            cursor.execute('UPDATE users SET posts_count = posts_count + 1 WHERE username = ?', (author,))
             conn.commit()
-            return True
-    except sqlite3.Error as e:
+        settle_uploads(app.config['UPLOAD_FOLDER'], staged)
+        timeline_worker.fan_out(blog_id, author)
+        invalidate_users(author)
+        page_cache.invalidate('feed', f'user:{author}')
+        sitemap_builder.mark_dirty(blog_id)
+        image_pipeline.submit(blog_id, image_urls)
+        return True
+    except DB_ERRORS as e:
         print(f"Database error in create_blog_with_images: {e}")
         return False
     except Exception as e:
@@ -384,87 +570,199 @@ def create_blog_with_images(title, content, author, channel, image_urls):
 
 
 # Messaging helper functions
+MESSAGE_PAGE_SIZE = 50
+CONVERSATION_PAGE_SIZE = 20
+
+def conversation_pair(user_a, user_b):
+    """Canonical (user1, user2) key of a conversation - the names in sorted order"""
+    return tuple(sorted((user_a, user_b)))
+
 def send_message(sender_username, receiver_username, message_text):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        user1, user2 = conversation_pair(sender_username, receiver_username)
+        unread_column = 'user1_unread' if receiver_username == user1 else 'user2_unread'
+        
+        with get_db() as conn:
             cursor = conn.cursor()
             
             # Sanitize inputs
             message_text = sanitize_input(message_text)[:1000]
             
-            # Insert message
-            cursor.execute('''
-                INSERT INTO messages (sender_username, receiver_username, message_text)
-                VALUES (?, ?, ?)
-            ''', (sender_username, receiver_username, message_text))
+            # Create the conversation on first contact. Look it up first - a
+            # conflicting insert would still use up an id from the sequence
+            cursor.execute('SELECT id FROM conversations WHERE user1_username = ? AND user2_username = ?', (user1, user2))
+            result = cursor.fetchone()
+            if not result:
+                cursor.execute('''
+                    INSERT INTO conversations (user1_username, user2_username)
+                    VALUES (?, ?)
+                    ON CONFLICT (user1_username, user2_username) DO NOTHING
+                ''', (user1, user2))
+                cursor.execute('SELECT id FROM conversations WHERE user1_username = ? AND user2_username = ?', (user1, user2))
+                result = cursor.fetchone()
+            conversation_id = result[0]
             
-            message_id = cursor.lastrowid
+            # Insert message
+            message_id = insert_returning_id(cursor, db_pool.backend, '''
+                INSERT INTO messages (sender_username, receiver_username, message_text, conversation_id)
+                VALUES (?, ?, ?, ?)
+            ''', (sender_username, receiver_username, message_text, conversation_id))
             
-            # Update or create conversation
-            cursor.execute('''
-                INSERT OR REPLACE INTO conversations (user1_username, user2_username, last_message_id, updated_at)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (min(sender_username, receiver_username), max(sender_username, receiver_username), message_id))
+            cursor.execute(f'''
+                UPDATE conversations
+                SET last_message_id = ?, updated_at = CURRENT_TIMESTAMP, {unread_column} = {unread_column} + 1
+                WHERE id = ?
+            ''', (message_id, conversation_id))
             
             conn.commit()
-            return True
+        event_hub.publish(f'user:{receiver_username}', 'message',
+                          {'id': message_id, 'from': sender_username, 'text': message_text[:100]})
+        return True
     except Exception as e:
         print(f"Error sending message: {e}")
         return False
 
-def get_conversations(username):
+def get_conversations(username, cursor=None, limit=CONVERSATION_PAGE_SIZE):
+    """Return (conversations, next_cursor) for a user's inbox, most recent first"""
+    position = decode_feed_cursor(cursor)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
+            cursor_obj = conn.cursor()
+            # The user is user1 in some conversations and user2 in others; each
+            # side is its own index range scan, merged and cut to one page
+            params = []
+            sides = []
+            for own, other in (('user1', 'user2'), ('user2', 'user1')):
+                side = f'''
+                    SELECT id, {other}_username AS other_user, {own}_unread AS unread, updated_at, last_message_id
+                    FROM conversations WHERE {own}_username = ?
+                '''
+                params.append(username)
+                if position:
+                    side += ' AND (updated_at, id) < (?, ?)'
+                    params.extend(position)
+                side += ' ORDER BY updated_at DESC, id DESC LIMIT ?'
+                params.append(limit + 1)
+                sides.append(f'SELECT * FROM ({side}) {own}_side')
+            cursor_obj.execute(' UNION ALL '.join(sides) + ' ORDER BY updated_at DESC, id DESC LIMIT ?',
+                               params + [limit + 1])
+            rows = cursor_obj.fetchall()
+            
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_feed_cursor(rows[-1][3], rows[-1][0])
+            
+            last_messages = {}
+            message_ids = [row[4] for row in rows if row[4]]
+            if message_ids:
+                placeholders = ', '.join('?' for _ in message_ids)
+                cursor_obj.execute(f'''
+                    SELECT id, sender_username, message_text, created_at
+                    FROM messages WHERE id IN ({placeholders})
+                ''', message_ids)
+                last_messages = {row[0]: row for row in cursor_obj.fetchall()}
+    except Exception as e:
+        print(f"Error getting conversations: {e}")
+        return [], None
+    
+    conversations = []
+    for row in rows:
+        last = last_messages.get(row[4])
+        conversations.append({
+            'id': row[0],
+            'other_user': row[1],
+            'unread': row[2] or 0,
+            'updated_at': row[3],
+            'last_sender': last[1] if last else None,
+            'last_message': last[2] if last else '',
+            'last_at': last[3] if last else row[3]
+        })
+    return conversations, next_cursor
+
+def get_messages(user1, user2, before_id=None, limit=MESSAGE_PAGE_SIZE):
+    """Return (messages, older_cursor) for one page of a thread, oldest first.
+
+    older_cursor is the before_id for the previous page, or None at the start.
+    """
+    try:
+        pair = conversation_pair(user1, user2)
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT c.*, m.message_text, m.created_at, m.sender_username,
-                       CASE WHEN c.user1_username = ? THEN c.user2_username ELSE c.user1_username END as other_user
+            query = '''
+                SELECT m.id, m.sender_username, m.receiver_username, m.message_text, m.created_at, m.is_read
                 FROM conversations c
-                LEFT JOIN messages m ON c.last_message_id = m.id
-                WHERE c.user1_username = ? OR c.user2_username = ?
-                ORDER BY c.updated_at DESC
-            ''', (username, username, username))
-            return cursor.fetchall()
+                JOIN messages m ON m.conversation_id = c.id
+                WHERE c.user1_username = ? AND c.user2_username = ?
+            '''
+            params = list(pair)
+            if before_id:
+                query += ' AND m.id < ?'
+                params.append(before_id)
+            query += ' ORDER BY m.id DESC LIMIT ?'
+            params.append(limit + 1)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
     except Exception as e:
-        print(f"Error getting conversations: {e}")
-        return []
-
-def get_messages(user1, user2, limit=50):
+        print(f"Error getting messages: {e}")
+        return [], None
+    
+    older_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        older_cursor = rows[-1][0]
+    
+    messages = [{
+        'id': row[0],
+        'sender': row[1],
+        'receiver': row[2],
+        'text': row[3],
+        'created_at': row[4],
+        'is_read': bool(row[5])
+    } for row in reversed(rows)]
+    return messages, older_cursor
+
+def mark_conversation_read(username, other_username):
+    """Mark the messages a user received in a conversation as read"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        user1, user2 = conversation_pair(username, other_username)
+        unread_column = 'user1_unread' if username == user1 else 'user2_unread'
+        with get_db() as conn:
             cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, {unread_column} FROM conversations
+                WHERE user1_username = ? AND user2_username = ?
+            ''', (user1, user2))
+            result = cursor.fetchone()
+            # Opening a thread with nothing unread costs no write
+            if not result or not result[1]:
+                return True
             cursor.execute('''
-                SELECT * FROM messages 
-                WHERE (sender_username = ? AND receiver_username = ?) 
-                   OR (sender_username = ? AND receiver_username = ?)
-                ORDER BY created_at DESC LIMIT ?
-            ''', (user1, user2, user2, user1, limit))
-            return cursor.fetchall()[::-1]
+                UPDATE messages SET is_read = TRUE
+                WHERE conversation_id = ? AND receiver_username = ? AND is_read = FALSE
+            ''', (result[0], username))
+            cursor.execute(f'UPDATE conversations SET {unread_column} = 0 WHERE id = ?', (result[0],))
+            conn.commit()
+        return True
     except Exception as e:
-        print(f"Error getting messages: {e}")
-        return []
+        print(f"Error marking conversation as read: {e}")
+        return False
 
 # Password reset helper functions
+# Expired token rows are deleted in the background
+reset_token_sweeper = ResetTokenSweeper(db_pool.connection)
+
 def generate_reset_token(username):
     """Generate secure password reset token"""
     try:
-        # Create token with username and current timestamp
-        token_data = {'username': username, 'timestamp': time.time()}
+        # The nonce makes every token unique and unguessable even without the key
+        token_data = {'username': username, 'nonce': secrets.token_urlsafe(16)}
         token = serializer.dumps(token_data, salt='password-reset')
         
-        # Store token hash in database
-        token_hash = generate_password_hash(token)
-        expires_at = datetime.now() + timedelta(minutes=30)  # 30 minute expiry
-        
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            # Invalidate old tokens for this user
-            cursor.execute('UPDATE password_reset_tokens SET used_at = CURRENT_TIMESTAMP WHERE username = ? AND used_at IS NULL', (username,))
-            # Insert new token
-            cursor.execute('''
-                INSERT INTO password_reset_tokens (username, token_hash, expires_at)
-                VALUES (?, ?, ?)
-            ''', (username, token_hash, expires_at))
+            # Invalidates older tokens for this user and stores the new digest
+            store_reset_token(cursor, username, token)
             conn.commit()
         
         return token
@@ -472,22 +770,22 @@ def generate_reset_token(username):
         print(f"Error generating reset token: {e}")
         return None
 
-def verify_reset_token(token, max_age=1800):  # 30 minutes
+def load_reset_token(token):
+    """Username from a reset token's signed payload, or None if forged or too old"""
+    try:
+        token_data = serializer.loads(token, salt='password-reset', max_age=RESET_TOKEN_MINUTES * 60)
+        return token_data['username']
+    except Exception:
+        return None
+
+def verify_reset_token(token):
     """Verify password reset token"""
+    username = load_reset_token(token)
+    if not username:
+        return None
     try:
-        # Decode token
-        token_data = serializer.loads(token, salt='password-reset', max_age=max_age)
-        username = token_data['username']
-        
-        # Check if token exists and is unused
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id FROM password_reset_tokens 
-                WHERE username = ? AND used_at IS NULL AND expires_at > CURRENT_TIMESTAMP
-            ''', (username,))
-            
-            if cursor.fetchone():
+        with get_db() as conn:
+            if find_reset_token(conn.cursor(), username, token):
                 return username
         return None
     except Exception as e:
@@ -495,19 +793,15 @@ def verify_reset_token(token, max_age=1800):  # 30 minutes
         return None
 
 def consume_reset_token(token):
-    """Mark token as used"""
+    """Mark token as used - returns the username only for the first caller"""
+    username = load_reset_token(token)
+    if not username:
+        return None
     try:
-        username = verify_reset_token(token)
-        if username:
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE password_reset_tokens 
-                    SET used_at = CURRENT_TIMESTAMP 
-                    WHERE username = ? AND used_at IS NULL
-                ''', (username,))
-                conn.commit()
-        return username
+        with get_db() as conn:
+            consumed = consume_reset_token_row(conn.cursor(), username, token)
+            conn.commit()
+        return username if consumed else None
     except Exception as e:
         print(f"Error consuming reset token: {e}")
         return None
@@ -559,37 +853,39 @@ def send_reset_email(email, username, token):
 # Comment helper functions
 def add_comment(blog_id, username, comment_text):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO comments (blog_id, username, comment_text)
                 VALUES (?, ?, ?)
             ''', (blog_id, username, sanitize_input(comment_text)[:500]))
+            cursor.execute('UPDATE blogs SET comments_count = comments_count + 1 WHERE id = ?', (blog_id,))
             
             # Get blog author to send notification
             cursor.execute('SELECT author_username, title FROM blogs WHERE id = ?', (blog_id,))
             blog_result = cursor.fetchone()
             
-            if blog_result and blog_result[0] != username:
-                blog_author = blog_result[0]
-                blog_title = blog_result[1]
-                create_notification(
-                    blog_author, 
-                    username, 
-                    'comment', 
-                    f'{username} commented on your blog "{blog_title[:30]}..."',
-                    blog_id
-                )
-            
             conn.commit()
-            return True
+        
+        if blog_result and blog_result[0] != username:
+            blog_author = blog_result[0]
+            blog_title = blog_result[1]
+            create_notification(
+                blog_author, 
+                username, 
+                'comment', 
+                f'{username} commented on your blog "{blog_title[:30]}..."',
+                blog_id
+            )
+        page_cache.invalidate('feed', f'blog:{blog_id}')
+        return True
     except Exception as e:
         print(f"Error adding comment: {e}")
         return False
 
 def get_comments(blog_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, username, comment_text, created_at
@@ -597,7 +893,7 @@ def get_comments(blog_id):
                 WHERE blog_id = ?
                 ORDER BY created_at ASC
             ''', (blog_id,))
-            return cursor.fetchall()
+            return Comment.fetch_all(cursor)
     except Exception as e:
         print(f"Error getting comments: {e}")
         return []
@@ -605,37 +901,56 @@ def get_comments(blog_id):
 # Follow system functions
 def follow_user(follower, following):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO follows (follower_username, following_username)
                 VALUES (?, ?)
             ''', (follower, following))
+            cursor.execute('UPDATE users SET following_count = following_count + 1 WHERE username = ?', (follower,))
+            cursor.execute('UPDATE users SET followers_count = followers_count + 1 WHERE username = ?', (following,))
+            backfill_timeline(cursor, follower, following)
             conn.commit()
-            # Create notification
-            create_notification(following, follower, 'follow', f'{follower} started following you')
-            return True
+        invalidate_users(follower, following)
+        page_cache.invalidate(f'user:{follower}', f'user:{following}')
+        # Create notification
+        create_notification(following, follower, 'follow', f'{follower} started following you')
+        return True
     except Exception as e:
         print(f"Error following user: {e}")
         return False
 
 def unfollow_user(follower, following):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        crossed_fanout_limit = False
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM follows 
                 WHERE follower_username = ? AND following_username = ?
             ''', (follower, following))
+            if cursor.rowcount:
+                cursor.execute('UPDATE users SET following_count = following_count - 1 WHERE username = ?', (follower,))
+                cursor.execute('UPDATE users SET followers_count = followers_count - 1 WHERE username = ?', (following,))
+                remove_author_from_timeline(cursor, follower, following)
+                cursor.execute('SELECT followers_count FROM users WHERE username = ?', (following,))
+                row = cursor.fetchone()
+                crossed_fanout_limit = bool(row) and row[0] == TIMELINE_FANOUT_LIMIT
             conn.commit()
-            return True
+        # Back under the limit: posts written above it were only merged in at
+        # read time, so copy them into the remaining followers' timelines
+        if crossed_fanout_limit:
+            timeline_worker.backfill_followers(following)
+        invalidate_users(follower, following)
+        page_cache.invalidate(f'user:{follower}', f'user:{following}')
+        return True
     except Exception as e:
         print(f"Error unfollowing user: {e}")
         return False
 
 def is_following(follower, following):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT 1 FROM follows 
@@ -648,42 +963,77 @@ def is_following(follower, following):
 
 def get_followers_count(username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM follows WHERE following_username = ?', (username,))
-            return cursor.fetchone()[0]
+            cursor.execute('SELECT followers_count FROM users WHERE username = ?', (username,))
+            result = cursor.fetchone()
+            return result[0] if result else 0
     except Exception as e:
         print(f"Error getting followers count: {e}")
         return 0
 
 def get_following_count(username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM follows WHERE follower_username = ?', (username,))
-            return cursor.fetchone()[0]
+            cursor.execute('SELECT following_count FROM users WHERE username = ?', (username,))
+            result = cursor.fetchone()
+            return result[0] if result else 0
     except Exception as e:
         print(f"Error getting following count: {e}")
         return 0
 
 # Notification system functions
+# Unread badge counts, invalidated whenever a user's notifications change.
+# Without CACHE_REDIS_URL each worker keeps its own copy, so the TTL bounds
+# how stale another worker's count can get.
+unread_count_cache = make_cache('unread_notifications', max_entries=10000,
+                                default_ttl=int(os.environ.get('NOTIFICATION_COUNT_TTL', 30)))
+
+# Live updates for open pages over /api/stream. Set EVENTS_REDIS_URL (or
+# CACHE_REDIS_URL) so events published by one worker reach streams on others.
+event_hub = make_event_hub()
+
+def on_write_behind_flush(blog_ids, recipients, notifications):
+    """Invalidate caches once queued likes and notifications are committed"""
+    for username in recipients:
+        unread_count_cache.delete(username)
+    if blog_ids:
+        page_cache.invalidate('feed', *[f'blog:{blog_id}' for blog_id in blog_ids])
+        publish_like_counts(blog_ids)
+    # Pushed only now that the rows are committed, so a client fetching
+    # /notifications in response will find them
+    for user_username, from_username, type, message, blog_id in notifications:
+        event_hub.publish(f'user:{user_username}', 'notification',
+                          {'type': type, 'from': from_username, 'message': message, 'blog_id': blog_id})
+
+def publish_like_counts(blog_ids):
+    """Push the committed like counts of a flushed batch to open pages"""
+    blog_ids = sorted(blog_ids)
+    placeholders = ', '.join('?' for _ in blog_ids)
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT id, likes_count FROM blogs WHERE id IN ({placeholders})', blog_ids)
+        counts = {str(row[0]): row[1] for row in cursor.fetchall()}
+    if counts:
+        event_hub.publish('likes', 'likes', counts)
+
+# Likes and notifications are queued and written in batches off the request
+# path (every WRITE_BEHIND_INTERVAL seconds, and on shutdown)
+write_buffer = WriteBehindBuffer(db_pool.connection, on_write_behind_flush)
+
 def create_notification(user_username, from_username, type, message, blog_id=None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO notifications (user_username, from_username, type, message, blog_id)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_username, from_username, type, message, blog_id))
-            conn.commit()
-            return True
+        # The SSE event goes out from on_write_behind_flush once it is written
+        write_buffer.add_notification(user_username, from_username, type, message, blog_id)
+        return True
     except Exception as e:
         print(f"Error creating notification: {e}")
         return False
 
 def get_notifications(username, limit=20):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, from_username, type, message, blog_id, is_read, created_at
@@ -692,86 +1042,96 @@ def get_notifications(username, limit=20):
                 ORDER BY created_at DESC
                 LIMIT ?
             ''', (username, limit))
-            return cursor.fetchall()
+            return Notification.fetch_all(cursor)
     except Exception as e:
         print(f"Error getting notifications: {e}")
         return []
 
 def get_unread_notifications_count(username):
+    count = unread_count_cache.get(username)
+    if count is not None:
+        return count
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT COUNT(*) FROM notifications 
                 WHERE user_username = ? AND is_read = FALSE
             ''', (username,))
-            return cursor.fetchone()[0]
+            count = cursor.fetchone()[0]
+        unread_count_cache.set(username, count)
+        return count
     except Exception as e:
         print(f"Error getting unread notifications count: {e}")
         return 0
 
 def mark_notifications_read(username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE notifications SET is_read = TRUE 
                 WHERE user_username = ? AND is_read = FALSE
             ''', (username,))
             conn.commit()
-            return True
+        unread_count_cache.delete(username)
+        return True
     except Exception as e:
         print(f"Error marking notifications as read: {e}")
         return False
 
 # Like system functions
+# like_blog/unlike_blog only queue the change; the write-behind flush inserts
+# the like, notifies the author and recounts likes_count in one batch
 def like_blog(blog_id, username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO likes (blog_id, username)
-                VALUES (?, ?)
-            ''', (blog_id, username))
-            
-            # Get blog author to send notification
-            cursor.execute('SELECT author_username, title FROM blogs WHERE id = ?', (blog_id,))
-            blog_result = cursor.fetchone()
-            
-            if blog_result and blog_result[0] != username:
-                blog_author = blog_result[0]
-                blog_title = blog_result[1]
-                create_notification(
-                    blog_author, 
-                    username, 
-                    'like', 
-                    f'{username} liked your blog "{blog_title[:30]}..."',
-                    blog_id
-                )
-            
-            conn.commit()
-            return True
+        write_buffer.set_like(blog_id, username, True)
+        return True
     except Exception as e:
         print(f"Error liking blog: {e}")
         return False
 
 def unlike_blog(blog_id, username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                DELETE FROM likes 
-                WHERE blog_id = ? AND username = ?
-            ''', (blog_id, username))
-            conn.commit()
-            return True
+        write_buffer.set_like(blog_id, username, False)
+        return True
     except Exception as e:
         print(f"Error unliking blog: {e}")
         return False
 
+def get_like_state(blog_id, username):
+    """Return (liked, likes_count) for a user, including their queued toggles.
+
+    Returns None if the blog does not exist.
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT likes_count, EXISTS (SELECT 1 FROM likes WHERE blog_id = ? AND username = ?)
+                FROM blogs WHERE id = ?
+            ''', (blog_id, username, blog_id))
+            result = cursor.fetchone()
+    except Exception as e:
+        print(f"Error getting like state: {e}")
+        return None
+    
+    if not result:
+        return None
+    likes_count = result[0] or 0
+    liked = bool(result[1])
+    pending = write_buffer.pending_like(blog_id, username)
+    if pending is not None and pending != liked:
+        likes_count += 1 if pending else -1
+        liked = pending
+    return liked, likes_count
+
 def is_liked_by_user(blog_id, username):
+    pending = write_buffer.pending_like(blog_id, username)
+    if pending is not None:
+        return pending
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT 1 FROM likes 
@@ -784,33 +1144,53 @@ def is_liked_by_user(blog_id, username):
 
 def get_likes_count(blog_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM likes WHERE blog_id = ?', (blog_id,))
-            return cursor.fetchone()[0]
+            cursor.execute('SELECT likes_count FROM blogs WHERE id = ?', (blog_id,))
+            result = cursor.fetchone()
+            return result[0] if result else 0
     except Exception as e:
         print(f"Error getting likes count: {e}")
         return 0
 
 # Routes
 @app.route('/')
+@page_cache.cached(lambda: ['feed'])
 def index():
     search_query = request.args.get('search', '').strip()
-    blogs = get_blogs()
+    next_cursor = None
     
     if search_query:
         # Search across all blogs regardless of channel
-        filtered_blogs = []
-        query_lower = search_query.lower()
-        for blog in blogs:
-            if (query_lower in blog['title'].lower() or 
-                query_lower in blog['content'].lower() or 
-                query_lower in blog['author'].lower()):
-                filtered_blogs.append(blog)
-        blogs = filtered_blogs
-    # Show all blogs to everyone (logged in or not)
-    
-    return render_template('index.html', blogs=blogs, search_query=search_query)
+        blogs = search_feed(search_query)
+    else:
+        # Show all blogs to everyone (logged in or not), one page at a time
+        blogs, next_cursor = get_feed_page(request.args.get('cursor'))
+    
+    return render_template('index.html', blogs=blogs, search_query=search_query, next_cursor=next_cursor)
+
+@app.route('/api/feed')
+def api_feed():
+    blogs, next_cursor = get_feed_page(request.args.get('cursor'))
+    return jsonify({'blogs': [blog.to_dict() for blog in blogs], 'next_cursor': next_cursor})
+
+@app.route('/following')
+def following_feed():
+    if 'username' not in session:
+        flash('Please login to see posts from people you follow!', 'error')
+        return redirect(url_for('login'))
+    
+    blogs, next_cursor = get_following_page(session['username'], request.args.get('cursor'))
+    return render_template('index.html', blogs=blogs, search_query='', next_cursor=next_cursor,
+                           feed_endpoint='following_feed')
+
+@app.route('/api/timeline')
+def api_timeline():
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+    
+    blogs, next_cursor = get_following_page(session['username'], request.args.get('cursor'))
+    return jsonify({'blogs': [blog.to_dict() for blog in blogs], 'next_cursor': next_cursor})
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -827,12 +1207,14 @@ def login():
                 flash('Password is required!', 'error')
                 return render_template('login_modern.html')
             
-            user = get_user_by_username(username)
+            password_hasher.admit(request.remote_addr, username)
+            user = get_user_by_username(username, use_cache=False)
             
-            if user and user.get('password_hash'):
-                if check_password_hash(user['password_hash'], password):
+            if user and user.password_hash:
+                if password_hasher.verify(user.password_hash, password):
+                    password_hasher.record_success(request.remote_addr, username)
                     session['username'] = username
-                    session['channel'] = user.get('channel', 'general')
+                    session['channel'] = user.channel or 'general'
                     session.permanent = True
                     flash('Login successful!', 'success')
                     return redirect(url_for('index'))
@@ -840,6 +1222,13 @@ def login():
                     flash('Incorrect password!', 'error')
             else:
                 flash('Username not found!', 'error')
+        except TooManyAttempts as e:
+            print(f"Login refused: {e}")
+            flash('Too many login attempts. Please wait a minute and try again.', 'error')
+            return render_template('login_modern.html'), 429
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login_modern.html'), 503
         except Exception as e:
             print(f"Login error: {e}")
             flash('An error occurred during login. Please try again.', 'error')
@@ -890,7 +1279,7 @@ def register():
                 return render_template('register_modern.html')
             
             # Check if user exists
-            existing_user = get_user_by_username(username)
+            existing_user = get_user_by_username(username, use_cache=False)
             if existing_user:
                 print(f"User already exists: {username}")
                 flash('Username already exists', 'error')
@@ -899,7 +1288,8 @@ def register():
             print(f"All validations passed, creating user...")
             
             # Create user
-            password_hash = generate_password_hash(password)
+            password_hasher.admit(request.remote_addr)
+            password_hash = password_hasher.hash(password)
             print(f"Password hash generated: {password_hash[:20]}...")
             
             success = create_user(
@@ -922,6 +1312,13 @@ def register():
                 print(f"Failed to create user: {username}")
                 flash('Registration failed. Username might already exist or database error.', 'error')
                 
+        except TooManyAttempts as e:
+            print(f"Registration refused: {e}")
+            flash('Too many attempts. Please wait a minute and try again.', 'error')
+            return render_template('register_modern.html'), 429
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('register_modern.html'), 503
         except Exception as e:
             print(f"Registration error: {e}")
             import traceback
@@ -931,6 +1328,7 @@ def register():
     return render_template('register_modern.html')
 
 @app.route('/blog/<int:blog_id>', methods=['GET', 'POST'])
+@page_cache.cached(lambda blog_id: [f'blog:{blog_id}'])
 def view_blog(blog_id):
     # Handle comment submission
     if request.method == 'POST' and 'username' in session:
@@ -945,43 +1343,30 @@ def view_blog(blog_id):
         return redirect(url_for('view_blog', blog_id=blog_id))
     
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM blogs WHERE id = ?', (blog_id,))
-            result = cursor.fetchone()
+            cursor.execute('''
+                SELECT id, title, content, author_username, channel, created_at, images, image_variants, likes_count
+                FROM blogs WHERE id = ?
+            ''', (blog_id,))
+            blog = Blog.fetch_one(cursor)
         
-        if not result:
+        if not blog:
             flash('Blog not found!', 'error')
             return redirect(url_for('index'))
-    except sqlite3.Error as e:
+    except DB_ERRORS as e:
         print(f"Database error in view_blog: {e}")
         flash('Error loading blog', 'error')
         return redirect(url_for('index'))
     
-    # Parse images
-    images = []
-    if result[6]:
-        try:
-            images = json.loads(result[6])
-        except (json.JSONDecodeError, TypeError):
-            images = []
-    
-    blog = {
-        'id': result[0],
-        'title': result[1],
-        'content': result[2],
-        'author': result[3],
-        'channel': result[4],
-        'date': result[5],
-        'images': images
-    }
-    
     # Get comments and likes
     comments = get_comments(blog_id)
-    likes_count = get_likes_count(blog_id)
+    likes_count = blog.likes or 0
     is_liked = False
     if 'username' in session:
-        is_liked = is_liked_by_user(blog_id, session['username'])
+        like_state = get_like_state(blog_id, session['username'])
+        if like_state:
+            is_liked, likes_count = like_state
     
     return render_template('blog_detail.html', blog=blog, comments=comments, likes_count=likes_count, is_liked=is_liked)
 
@@ -1023,43 +1408,45 @@ def create_blog():
                 flash('Content cannot exceed 10,000 characters!', 'error')
                 return render_template('create.html')
             
-            # Handle image uploads with validation
-            image_urls = []
+            # File type validation, before anything is written to disk
+            files = [file for file in files if file and file.filename]
             for file in files:
-                if file and file.filename:
-                    # File type validation
-                    if not allowed_file(file.filename):
-                        flash('Invalid file type! Only PNG, JPG, JPEG, GIF, WEBP allowed.', 'error')
-                        return render_template('create.html')
-                    
-                    # File size validation (5MB max)
-                    file.seek(0, 2)  # Go to end of file
-                    file_size = file.tell()
-                    file.seek(0)  # Reset to beginning
-                    
-                    if file_size > 5 * 1024 * 1024:  # 5MB
-                        flash('File too large! Maximum size is 5MB per image.', 'error')
-                        return render_template('create.html')
-                    
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    
-                    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(file_path)
-                    
-                    image_urls.append(unique_filename)
+                if not allowed_file(file.filename):
+                    flash('Invalid file type! Only PNG, JPG, JPEG, GIF, WEBP allowed.', 'error')
+                    return render_template('create.html')
             
             # Final check: Must have at least one image
-            if not image_urls:
+            if not files:
                 flash('At least one valid image is required!', 'error')
                 return render_template('create.html')
             
-            success = create_blog_with_images(title, content, session['username'], session.get('channel', 'general'), image_urls)
+            # Stream uploads to content-addressed files (5MB max each);
+            # identical images are stored only once
+            image_urls = []
+            new_files = []
+            staged = []
+            try:
+                for file in files:
+                    filename, staged_path = save_upload(file, app.config['UPLOAD_FOLDER'], MAX_IMAGE_BYTES)
+                    image_urls.append(filename)
+                    if staged_path:
+                        staged.append((filename, staged_path))
+                    else:
+                        new_files.append(filename)
+            except UploadTooLarge:
+                remove_media_files(app.config['UPLOAD_FOLDER'], new_files)
+                discard_staged(staged)
+                flash('File too large! Maximum size is 5MB per image.', 'error')
+                return render_template('create.html')
+            
+            success = create_blog_with_images(title, content, session['username'], session.get('channel', 'general'),
+                                              image_urls, staged)
             if success:
                 flash('Blog created successfully!', 'success')
                 return redirect(url_for('index'))
             else:
+                remove_media_files(app.config['UPLOAD_FOLDER'], new_files)
+                discard_staged(staged)
                 flash('Failed to create blog. Please try again.', 'error')
         
         except Exception as e:
@@ -1070,11 +1457,12 @@ def create_blog():
 
 def update_user_password(username, password_hash):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, username))
             conn.commit()
-            return True
+        invalidate_users(username)
+        return True
     except Exception as e:
         print(f"Error updating password: {e}")
         return False
@@ -1093,10 +1481,12 @@ def profile():
         
         # Update bio in database
         try:
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_db() as conn:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE users SET bio = ? WHERE username = ?', (bio[:500], username))
                 conn.commit()
+            invalidate_users(username)
+            page_cache.invalidate(f'user:{username}')
             flash('Profile updated successfully!', 'success')
         except Exception as e:
             print(f"Error updating profile: {e}")
@@ -1105,41 +1495,18 @@ def profile():
     
     # Get user's blogs
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM blogs WHERE author_username = ? ORDER BY created_at DESC', (username,))
-            user_blogs = cursor.fetchall()
-            
-            # Get user bio
-            cursor.execute('SELECT bio FROM users WHERE username = ?', (username,))
-            bio_result = cursor.fetchone()
-            bio = bio_result[0] if bio_result and bio_result[0] else ''
+            cursor.execute('''
+                SELECT id, title, content, author_username, channel, created_at, images
+                FROM blogs WHERE author_username = ? ORDER BY created_at DESC
+            ''', (username,))
+            blogs = Blog.fetch_all(cursor)
     except Exception as e:
         print(f"Error fetching profile data: {e}")
-        user_blogs = []
-        bio = ''
-    
-    blogs = []
-    for row in user_blogs:
-        # Parse images
-        images = []
-        if row[6]:
-            try:
-                images = json.loads(row[6])
-            except (json.JSONDecodeError, TypeError):
-                images = []
-        
-        blog = {
-            'id': row[0],
-            'title': row[1],
-            'content': row[2],
-            'author': row[3],
-            'channel': row[4],
-            'date': row[5],
-            'images': images
-        }
-        blogs.append(blog)
+        blogs = []
     
+    bio = (user.bio if user else '') or ''
     return render_template('profile.html', user=user, blogs=blogs, bio=bio)
 
 @app.route('/logout')
@@ -1169,7 +1536,7 @@ def forgot_password():
         
         # Verify username and email combination
         try:
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_db() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT username FROM users WHERE username = ? AND LOWER(email) = ?', (username, email))
                 result = cursor.fetchone()
@@ -1209,9 +1576,20 @@ def reset_password(token):
             flash('Passwords do not match!', 'error')
             return render_template('reset_password.html', token=token)
         
+        try:
+            password_hasher.admit(request.remote_addr, username)
+            password_hash = password_hasher.hash(password, method='pbkdf2:sha256', salt_length=16)
+        except TooManyAttempts as e:
+            print(f"Password reset refused: {e}")
+            flash('Too many attempts. Please wait a minute and try again.', 'error')
+            return render_template('reset_password.html', token=token), 429
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('reset_password.html', token=token), 503
+        
         consumed_username = consume_reset_token(token)
         if consumed_username:
-            success = update_user_password(consumed_username, generate_password_hash(password, method='pbkdf2:sha256', salt_length=16))
+            success = update_user_password(consumed_username, password_hash)
             if success:
                 flash('Password reset successful! Please login with your new password.', 'success')
                 return redirect(url_for('login'))
@@ -1230,21 +1608,21 @@ def edit_blog(blog_id):
         return redirect(url_for('login'))
     
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM blogs WHERE id = ?', (blog_id,))
-            result = cursor.fetchone()
-    except sqlite3.Error as e:
+            cursor.execute('SELECT id, title, content, author_username, channel, created_at FROM blogs WHERE id = ?', (blog_id,))
+            blog = Blog.fetch_one(cursor)
+    except DB_ERRORS as e:
         print(f"Database error in edit_blog: {e}")
         flash('Error loading blog', 'error')
         return redirect(url_for('index'))
     
-    if not result:
+    if not blog:
         flash('Blog not found!', 'error')
         return redirect(url_for('index'))
     
     # Check if user owns this blog
-    if result[3] != session['username']:
+    if blog.author != session['username']:
         flash('You can only edit your own blogs!', 'error')
         return redirect(url_for('index'))
     
@@ -1258,25 +1636,20 @@ def edit_blog(blog_id):
             flash('Content must be at least 10 characters!', 'error')
         else:
             try:
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_db() as conn:
                     cursor = conn.cursor()
-                    cursor.execute('UPDATE blogs SET title = ?, content = ? WHERE id = ?', (title, content, blog_id))
+                    unindex_blog(conn, db_pool.backend, blog_id)
+                    cursor.execute('UPDATE blogs SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?', (title, content, blog_id))
+                    index_blog(conn, db_pool.backend, blog_id)
                     conn.commit()
+                page_cache.invalidate('feed', f'blog:{blog_id}', f'user:{blog.author}')
+                sitemap_builder.mark_dirty(blog_id)
                 flash('Blog updated successfully!', 'success')
                 return redirect(url_for('view_blog', blog_id=blog_id))
-            except sqlite3.Error as e:
+            except DB_ERRORS as e:
                 print(f"Edit blog error: {e}")
                 flash('Failed to update blog. Please try again.', 'error')
     
-    blog = {
-        'id': result[0],
-        'title': result[1],
-        'content': result[2],
-        'author': result[3],
-        'channel': result[4],
-        'date': result[5]
-    }
-    
     return render_template('edit_blog.html', blog=blog)
 
 @app.route('/delete/<int:blog_id>', methods=['POST'])
@@ -1286,9 +1659,9 @@ def delete_blog(blog_id):
         return redirect(url_for('login'))
     
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT author_username FROM blogs WHERE id = ?', (blog_id,))
+            cursor.execute('SELECT author_username, images FROM blogs WHERE id = ?', (blog_id,))
             result = cursor.fetchone()
             
             if not result:
@@ -1299,10 +1672,27 @@ def delete_blog(blog_id):
                 flash('You can only delete your own blogs!', 'error')
                 return redirect(url_for('index'))
             
+            unindex_blog(conn, db_pool.backend, blog_id)
+            # Rows referencing the blog go first - PostgreSQL enforces the foreign keys
+            cursor.execute('DELETE FROM comments WHERE blog_id = ?', (blog_id,))
+            cursor.execute('DELETE FROM likes WHERE blog_id = ?', (blog_id,))
+            cursor.execute('DELETE FROM notifications WHERE blog_id = ?', (blog_id,))
+            remove_blog_from_timelines(cursor, blog_id)
             cursor.execute('DELETE FROM blogs WHERE id = ?', (blog_id,))
+            cursor.execute('UPDATE users SET posts_count = posts_count - 1 WHERE username = ?', (result[0],))
+            orphaned_files = release_media(cursor, load_json_column(result[1], []))
             conn.commit()
+        if orphaned_files:
+            # An upload of the same image may have taken a new reference since
+            with get_db() as conn:
+                orphaned_files = unreferenced_media(conn.cursor(), orphaned_files)
+            remove_media_files(app.config['UPLOAD_FOLDER'], orphaned_files)
+        unread_count_cache.delete(result[0])
+        invalidate_users(result[0])
+        page_cache.invalidate('feed', f'blog:{blog_id}', f'user:{result[0]}')
+        sitemap_builder.mark_dirty(blog_id)
         flash('Blog deleted successfully!', 'success')
-    except sqlite3.Error as e:
+    except DB_ERRORS as e:
         print(f"Delete blog error: {e}")
         flash('Failed to delete blog. Please try again.', 'error')
     
@@ -1312,49 +1702,6 @@ def delete_blog(blog_id):
 def favicon():
     return '', 204
 
-@app.route('/sitemap.xml')
-def sitemap():
-    """Generate XML sitemap for SEO"""
-    pages = []
-    base_url = 'https://my-blog-app-utli.onrender.com'
-    
-    # Static pages
-    pages.append({'loc': f'{base_url}/', 'priority': '1.0', 'changefreq': 'daily'})
-    pages.append({'loc': f'{base_url}/login', 'priority': '0.5', 'changefreq': 'monthly'})
-    pages.append({'loc': f'{base_url}/register', 'priority': '0.5', 'changefreq': 'monthly'})
-    
-    # Blog posts
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, created_at FROM blogs ORDER BY created_at DESC')
-            blogs = cursor.fetchall()
-            for blog_id, created_at in blogs:
-                pages.append({
-                    'loc': f'{base_url}/blog/{blog_id}',
-                    'priority': '0.8',
-                    'changefreq': 'weekly',
-                    'lastmod': created_at.split()[0] if created_at else datetime.now().strftime('%Y-%m-%d')
-                })
-    except Exception as e:
-        print(f"Sitemap error: {e}")
-    
-    sitemap_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    sitemap_xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    for page in pages:
-        sitemap_xml += '  <url>\n'
-        sitemap_xml += f'    <loc>{page["loc"]}</loc>\n'
-        if 'lastmod' in page:
-            sitemap_xml += f'    <lastmod>{page["lastmod"]}</lastmod>\n'
-        sitemap_xml += f'    <changefreq>{page["changefreq"]}</changefreq>\n'
-        sitemap_xml += f'    <priority>{page["priority"]}</priority>\n'
-        sitemap_xml += '  </url>\n'
-    sitemap_xml += '</urlset>'
-    
-    response = make_response(sitemap_xml)
-    response.headers['Content-Type'] = 'application/xml'
-    return response
-
 @app.route('/robots.txt')
 def robots():
     """Robots.txt for search engines"""
@@ -1373,13 +1720,26 @@ def google_verification():
 
 @app.route('/static/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve uploaded images"""
-    print(f"Image requested: {filename}")
-    try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    except FileNotFoundError:
-        print(f"Image not found: {filename}")
-        return '', 404
+    """Serve uploaded images - upload names are unique, so they never change"""
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        return 'File not found', 404
+    
+    if UPLOAD_SENDFILE_MODE == 'x-accel':
+        # nginx streams the file (and handles ranges/conditionals) itself
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = UPLOAD_ACCEL_PREFIX + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    else:
+        # Content-addressed names carry their own SHA-256, a free strong ETag
+        stem = filename.rsplit('.', 1)[0]
+        etag = stem if re.fullmatch(r'[0-9a-f]{64}', stem) else True
+        response = send_file(path, etag=etag, conditional=True, max_age=UPLOAD_CACHE_MAX_AGE)
+    
+    response.cache_control.public = True
+    response.cache_control.max_age = UPLOAD_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/follow/<username>', methods=['POST'])
 def follow_user_route(username):
@@ -1426,6 +1786,109 @@ def notifications_count():
     count = get_unread_notifications_count(session['username'])
     return jsonify({'count': count})
 
+@app.route('/messages')
+def inbox():
+    if 'username' not in session:
+        flash('Please login to view messages!', 'error')
+        return redirect(url_for('login'))
+    
+    conversations, next_cursor = get_conversations(session['username'], request.args.get('cursor'))
+    return render_template('messages.html', conversations=conversations, next_cursor=next_cursor)
+
+@app.route('/messages/<username>', methods=['GET', 'POST'])
+def conversation(username):
+    if 'username' not in session:
+        flash('Please login to send messages!', 'error')
+        return redirect(url_for('login'))
+    
+    current_user = session['username']
+    if username == current_user:
+        flash('You cannot message yourself!', 'error')
+        return redirect(url_for('inbox'))
+    
+    other_user = get_user_by_username(username)
+    if not other_user:
+        flash('User not found!', 'error')
+        return redirect(url_for('inbox'))
+    
+    if request.method == 'POST':
+        message_text = request.form.get('message', '').strip()
+        if not message_text:
+            flash('Message cannot be empty!', 'error')
+        elif not send_message(current_user, username, message_text):
+            flash('Failed to send message. Please try again.', 'error')
+        return redirect(url_for('conversation', username=username))
+    
+    messages, older_cursor = get_messages(current_user, username, request.args.get('before', type=int))
+    mark_conversation_read(current_user, username)
+    return render_template('conversation.html', other_user=other_user, messages=messages, older_cursor=older_cursor)
+
+# Streams are long-lived: under gthread each one holds a worker thread, so
+# a worker only accepts STREAM_MAX_CONNECTIONS of them - by default half its
+# threads - and refuses the rest so ordinary requests always have threads
+# left. gevent workers hold a greenlet per stream and take many more.
+# Browsers reconnect on their own after STREAM_MAX_SECONDS.
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_MAX_SECONDS = int(os.environ.get('STREAM_MAX_SECONDS', 300))
+if os.environ.get('GUNICORN_WORKER_CLASS') == 'gevent':
+    _default_stream_limit = 500
+else:
+    _default_stream_limit = max(1, int(os.environ.get('GUNICORN_THREADS', 4)) // 2)
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', _default_stream_limit))
+# Seconds a refused client waits before trying again
+STREAM_RETRY_AFTER = 60
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+@app.route('/api/stream')
+def event_stream():
+    """Server-Sent Events: notifications and messages for the user, like counts for everyone"""
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': 'Login required'}), 401
+    
+    if not stream_slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'message': 'Too many live streams, try again later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(STREAM_RETRY_AFTER)
+        return response
+    
+    subscription = event_hub.subscribe([f"user:{session['username']}", 'likes'])
+    
+    def generate():
+        yield 'retry: 5000\n\n'
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            item = subscription.get(timeout=min(STREAM_KEEPALIVE_SECONDS, remaining))
+            if item is None:
+                # Comment line - keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+            else:
+                yield format_sse(*item)
+    
+    def close():
+        # Runs when the server closes the response, even if the client went
+        # away before the first event was sent
+        subscription.close()
+        stream_slots.release()
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(close)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of request and query metrics"""
+    if not METRICS_ENABLED or not METRICS_TOKEN:
+        return 'Not found', 404
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return 'Unauthorized', 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/security-question/<username>')
 def get_security_question_api(username):
     question = get_user_security_question(username)
@@ -1441,20 +1904,25 @@ def like_blog_route(blog_id):
     
     username = session['username']
     
-    if is_liked_by_user(blog_id, username):
+    # One read for the current state; the toggle itself is queued
+    like_state = get_like_state(blog_id, username)
+    if like_state is None:
+        return jsonify({'success': False, 'message': 'Blog not found'}), 404
+    liked, likes_count = like_state
+    
+    if liked:
         if unlike_blog(blog_id, username):
-            likes_count = get_likes_count(blog_id)
-            return jsonify({'success': True, 'liked': False, 'likes_count': likes_count})
+            return jsonify({'success': True, 'liked': False, 'likes_count': max(likes_count - 1, 0)})
         else:
             return jsonify({'success': False, 'message': 'Failed to unlike'}), 500
     else:
         if like_blog(blog_id, username):
-            likes_count = get_likes_count(blog_id)
-            return jsonify({'success': True, 'liked': True, 'likes_count': likes_count})
+            return jsonify({'success': True, 'liked': True, 'likes_count': likes_count + 1})
         else:
             return jsonify({'success': False, 'message': 'Failed to like'}), 500
 
 @app.route('/user/<username>')
+@page_cache.cached(lambda username: [f'user:{username}'])
 def user_profile(username):
     user = get_user_by_username(username)
     if not user:
@@ -1463,42 +1931,21 @@ def user_profile(username):
     
     # Get user's blogs
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM blogs WHERE author_username = ? ORDER BY created_at DESC', (username,))
-            user_blogs = cursor.fetchall()
-            
-            cursor.execute('SELECT bio FROM users WHERE username = ?', (username,))
-            bio_result = cursor.fetchone()
-            bio = bio_result[0] if bio_result and bio_result[0] else ''
+            cursor.execute('''
+                SELECT id, title, content, author_username, channel, created_at, images, image_variants
+                FROM blogs WHERE author_username = ? ORDER BY created_at DESC
+            ''', (username,))
+            blogs = Blog.fetch_all(cursor)
     except Exception as e:
         print(f"Error fetching user profile data: {e}")
-        user_blogs = []
-        bio = ''
+        blogs = []
     
-    blogs = []
-    for row in user_blogs:
-        images = []
-        if row[6]:
-            try:
-                images = json.loads(row[6])
-            except (json.JSONDecodeError, TypeError):
-                images = []
-        
-        blog = {
-            'id': row[0],
-            'title': row[1],
-            'content': row[2],
-            'author': row[3],
-            'channel': row[4],
-            'date': row[5],
-            'images': images
-        }
-        blogs.append(blog)
-    
-    # Get follow stats
-    followers_count = get_followers_count(username)
-    following_count = get_following_count(username)
+    bio = user.bio or ''
+    # Follow stats are kept on the user row
+    followers_count = user.followers_count or 0
+    following_count = user.following_count or 0
     
     # Check if current user is following this user
     is_following_user = False
@@ -1517,7 +1964,7 @@ def user_profile(username):
 def debug_blogs():
     """Debug route to see what's in database"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT id, title, images FROM blogs')
             results = cursor.fetchall()
@@ -1527,10 +1974,10 @@ def debug_blogs():
 
 @app.errorhandler(404)
 def not_found(error):
-    print(f"404 Error: {request.url}")
     # Don't redirect static files (images, css, js) - just return 404
     if request.path.startswith('/static/'):
         return 'File not found', 404
+    print(f"404 Error: {request.url}")
     return redirect(url_for('index'))
 
 @app.context_processor
@@ -1545,6 +1992,69 @@ def inject_user():
         'notification_count': notification_count
     }
 
+# Background work per process
+# Periodic WAL checkpoints on SQLite (see SQLITE_CHECKPOINT_INTERVAL)
+wal_checkpointer = WalCheckpointer(db_pool)
+
+def start_background_tasks():
+    """Start this process's background threads"""
+    event_hub.start()
+    reset_token_sweeper.start()
+    timeline_worker.start()
+    wal_checkpointer.start()
+
+def init_worker():
+    """Set up a gunicorn worker (gunicorn_config.post_worker_init).
+
+    With preload_app the pools, queues and locks below were created in the
+    master and copied by fork; the worker starts them over and then starts
+    its own background threads. Doing this from the gunicorn hook rather than
+    os.register_at_fork keeps other forks, such as the password hashing pool,
+    from resetting state or starting threads.
+    """
+    reset_pools_after_fork()
+    image_pipeline.reset_after_fork()
+    timeline_worker.reset_after_fork()
+    write_buffer.reset_after_fork()
+    event_hub.reset_after_fork()
+    password_hasher.reset_after_fork()
+    start_background_tasks()
+
+# Under gunicorn init_worker() starts them in each worker, so the master
+# never runs background threads. When run as "python app.py" the hashing
+# processes import this file as __mp_main__; they must not start them either.
+if 'gunicorn' not in sys.modules and __name__ != '__mp_main__':
+    start_background_tasks()
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Rebuild follower, post, like, comment and unread message counters from source tables"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        reconcile_counters(cursor)
+        reconcile_conversation_unread(cursor)
+    print("Counters reconciled")
+
+@app.cli.command('import-legacy-users')
+def import_legacy_users_command():
+    """Copy accounts from users.json into the users table (migration 8 runs this once)"""
+    with db_pool.connection() as conn:
+        imported = import_legacy_users(conn.cursor(), db_pool.backend)
+    print(f"{imported} accounts imported; {LEGACY_USERS_FILE} is no longer read and can be archived")
+
+@app.cli.command('checkpoint-wal')
+def checkpoint_wal_command():
+    """Fold the SQLite write-ahead log into the database file and truncate it"""
+    if db_pool.backend != 'sqlite':
+        print("Only needed for SQLite")
+        return
+    with db_pool.connection() as conn:
+        busy, wal_pages, checkpointed = checkpoint_wal(conn)
+    if busy:
+        print(f"Checkpoint blocked by active readers ({checkpointed}/{wal_pages} pages copied)")
+    else:
+        print(f"Checkpointed {checkpointed} pages")
+
 if __name__ == '__main__':
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     init_db()
@@ -0,0 +1,467 @@
+"""Seed a benchmark dataset and measure request throughput.
+
+Seeding writes to the database the app is configured for (blog_app.db in
+the current directory, or DATABASE_URL), so run it against a scratch copy:
+
+    python benchmark.py seed --users 500 --blogs 5000
+    python benchmark.py run --output baseline.json
+    python benchmark.py run --compare baseline.json
+    python benchmark.py run --url http://127.0.0.1:8000 --concurrency 16
+
+Without --url the routes are driven in-process through the Flask test
+client; with --url they go over HTTP to a running server. Every seeded user
+has the password BENCH_PASSWORD.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+BENCH_PREFIX = 'bench_'
+BENCH_PASSWORD = 'Bench-passw0rd'
+# Fail a comparison when latency grows or throughput drops by more than this
+DEFAULT_THRESHOLD = 0.20
+# Users logged in per run; their cookies are shared by every logged-in
+# session, keeping a run well under the app's per-IP login attempt limit
+MAX_LOGINS = 4
+
+WORDS = ('python flask database cache latency index query server travel music '
+         'coffee garden winter summer recipe design photo story weekend review').split()
+
+SCENARIOS = ('feed', 'blog', 'profile', 'search', 'like')
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _timestamp(rng, now):
+    moment = now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _pairs(rng, count, left, right, distinct=True):
+    """Up to count random (l, r) pairs, unique and with l != r"""
+    pairs = set()
+    attempts = 0
+    while len(pairs) < count and attempts < count * 10:
+        attempts += 1
+        a, b = rng.choice(left), rng.choice(right)
+        if distinct and a == b:
+            continue
+        pairs.add((a, b))
+    return list(pairs)
+
+
+def seed(conn, backend, users, blogs, likes, comments, follows, notifications, seed_value=1):
+    """Insert a synthetic dataset and rebuild everything derived from it"""
+    from werkzeug.security import generate_password_hash
+    from counters import reconcile_counters
+
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT 1 FROM users WHERE username = ?', (f'{BENCH_PREFIX}user_0',))
+    if cursor.fetchone():
+        raise SystemExit('Benchmark data is already seeded in this database')
+
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    usernames = [f'{BENCH_PREFIX}user_{i}' for i in range(users)]
+    cursor.executemany('''
+        INSERT INTO users (username, email, password_hash, channel, created_at, bio, security_question, security_answer)
+        VALUES (?, ?, ?, 'general', ?, ?, 'Benchmark?', 'yes')
+    ''', [(name, f'{name}@example.com', password_hash, _timestamp(rng, now), _sentence(rng, 8))
+          for name in usernames])
+
+    blog_rows = []
+    for _ in range(blogs):
+        created = _timestamp(rng, now)
+        blog_rows.append((_sentence(rng, 5).title(), _sentence(rng, 120), rng.choice(usernames), created, created))
+    cursor.executemany('''
+        INSERT INTO blogs (title, content, author_username, channel, created_at, updated_at, images)
+        VALUES (?, ?, ?, 'general', ?, ?, '[]')
+    ''', blog_rows)
+
+    cursor.execute('SELECT id, author_username, created_at FROM blogs WHERE author_username LIKE ?',
+                   (f'{BENCH_PREFIX}%',))
+    seeded_blogs = cursor.fetchall()
+    blog_ids = [row[0] for row in seeded_blogs]
+
+    cursor.executemany('INSERT INTO likes (blog_id, username, created_at) VALUES (?, ?, ?)',
+                       [(blog_id, name, _timestamp(rng, now))
+                        for blog_id, name in _pairs(rng, likes, blog_ids, usernames, distinct=False)])
+    cursor.executemany('INSERT INTO comments (blog_id, username, comment_text, created_at) VALUES (?, ?, ?, ?)',
+                       [(rng.choice(blog_ids), rng.choice(usernames), _sentence(rng, 12), _timestamp(rng, now))
+                        for _ in range(comments)])
+    follow_pairs = _pairs(rng, follows, usernames, usernames)
+    cursor.executemany('INSERT INTO follows (follower_username, following_username, created_at) VALUES (?, ?, ?)',
+                       [(follower, following, _timestamp(rng, now)) for follower, following in follow_pairs])
+    cursor.executemany('''
+        INSERT INTO notifications (user_username, from_username, type, message, blog_id, is_read, created_at)
+        VALUES (?, ?, 'like', ?, ?, ?, ?)
+    ''', [(rng.choice(usernames), name, f'{name} liked your blog', rng.choice(blog_ids), rng.random() < 0.7,
+           _timestamp(rng, now)) for name in (rng.choice(usernames) for _ in range(notifications))])
+
+    # Materialized timelines: each author's own posts plus their followers' copies
+    followers = {}
+    for follower, following in follow_pairs:
+        followers.setdefault(following, []).append(follower)
+    cursor.executemany('INSERT INTO timeline (username, blog_id, author_username, created_at) VALUES (?, ?, ?, ?)',
+                       [(reader, blog_id, author, created_at)
+                        for blog_id, author, created_at in seeded_blogs
+                        for reader in [author] + followers.get(author, [])])
+
+    reconcile_counters(cursor)
+    if backend == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blogs_fts'")
+        if cursor.fetchone():
+            cursor.execute("INSERT INTO blogs_fts(blogs_fts) VALUES('rebuild')")
+    conn.commit()
+    return {'users': users, 'blogs': len(blog_ids), 'likes': likes, 'comments': comments,
+            'follows': len(follow_pairs), 'notifications': notifications}
+
+
+def load_targets(conn):
+    """Seeded usernames and blog ids to spread requests over"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT username FROM users WHERE username LIKE ?', (f'{BENCH_PREFIX}%',))
+    usernames = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT id FROM blogs WHERE author_username LIKE ?', (f'{BENCH_PREFIX}%',))
+    blog_ids = [row[0] for row in cursor.fetchall()]
+    if not usernames or not blog_ids:
+        raise SystemExit('No benchmark data found - run "python benchmark.py seed" first')
+    return usernames, blog_ids
+
+
+def scenario_request(name, rng, usernames, blog_ids):
+    """(method, path) for one request of a scenario"""
+    if name == 'feed':
+        return 'GET', '/'
+    if name == 'blog':
+        return 'GET', f'/blog/{rng.choice(blog_ids)}'
+    if name == 'profile':
+        return 'GET', f'/user/{rng.choice(usernames)}'
+    if name == 'search':
+        return 'GET', '/?' + urlencode({'search': rng.choice(WORDS)})
+    if name == 'like':
+        return 'POST', f'/like/{rng.choice(blog_ids)}'
+    raise ValueError(f'Unknown scenario: {name}')
+
+
+def _session_cookie(set_cookie_values, current):
+    """The session cookie from a response's Set-Cookie headers, else current"""
+    for value in set_cookie_values:
+        if value.startswith('session='):
+            return value.split(';', 1)[0]
+    return current
+
+
+class TestClientSession:
+    """Sends requests in-process through app.test_client()"""
+
+    def __init__(self, flask_app, username=None, cookie=None):
+        self.flask_app = flask_app
+        # The cookie is handled by hand, as in HTTPSession, so clones can share a login
+        self.client = flask_app.test_client(use_cookies=False)
+        self.cookie = cookie
+        if username:
+            response = self.client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+            self.cookie = _session_cookie(response.headers.getlist('Set-Cookie'), self.cookie)
+            if response.status_code != 302 or not self.cookie:
+                raise SystemExit(f'Login as {username} failed ({response.status_code})')
+
+    def clone(self):
+        """A new session with this one's login"""
+        return TestClientSession(self.flask_app, cookie=self.cookie)
+
+    def request(self, method, path):
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        response = self.client.open(path, method=method, headers=headers)
+        response.close()
+        self.cookie = _session_cookie(response.headers.getlist('Set-Cookie'), self.cookie)
+        return response.status_code
+
+
+class HTTPSession:
+    """Sends requests over one keep-alive HTTP connection"""
+
+    def __init__(self, base_url, username=None, cookie=None):
+        self.base_url = base_url
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=30)
+        self.cookie = cookie
+        if username:
+            body = urlencode({'username': username, 'password': BENCH_PASSWORD})
+            status = self.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            if status != 302 or not self.cookie:
+                raise SystemExit(f'Login as {username} failed ({status})')
+
+    def clone(self):
+        """A new connection with this session's login"""
+        return HTTPSession(self.base_url, cookie=self.cookie)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            # Sent by hand: the session cookie is marked Secure even over plain HTTP
+            headers['Cookie'] = self.cookie
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        self.cookie = _session_cookie(
+            [value for header, value in response.getheaders() if header.lower() == 'set-cookie'], self.cookie)
+        return response.status
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, sessions, requests_count, warmup, usernames, blog_ids, seed_value):
+    """Drive one scenario with one thread per session; returns latencies and errors"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_session = max(1, requests_count // len(sessions))
+
+    def worker(index, session, count, record):
+        rng = random.Random(seed_value * 1000 + index)
+        for _ in range(count):
+            method, path = scenario_request(name, rng, usernames, blog_ids)
+            started = time.perf_counter()
+            try:
+                status = session.request(method, path)
+            except Exception as e:
+                print(f"Request {method} {path} failed: {e}")
+                status = None
+            elapsed = time.perf_counter() - started
+            if record:
+                with lock:
+                    latencies.append(elapsed)
+                    if status is None or status >= 400:
+                        errors[0] += 1
+
+    def run_all(count, record):
+        threads = [threading.Thread(target=worker, args=(i, session, count, record))
+                   for i, session in enumerate(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if warmup:
+        run_all(max(1, warmup // len(sessions)), False)
+    started = time.perf_counter()
+    run_all(per_session, True)
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def summarize(latencies, errors, wall_seconds, queries_per_request):
+    ordered = sorted(latencies)
+    to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'requests_per_second': round(len(ordered) / wall_seconds, 2) if wall_seconds else None,
+        'mean_ms': to_ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': to_ms(percentile(ordered, 0.50)),
+        'p90_ms': to_ms(percentile(ordered, 0.90)),
+        'p99_ms': to_ms(percentile(ordered, 0.99)),
+        'max_ms': to_ms(ordered[-1]) if ordered else None,
+        'queries_per_request': round(queries_per_request, 2) if queries_per_request is not None else None,
+    }
+
+
+def _in_process_queries(metrics):
+    histogram = metrics.queries_per_request
+    return histogram.total, histogram.count
+
+
+def _scraped_queries(base_url, token):
+    """Query totals from a server's /metrics (needs METRICS_TOKEN) - only meaningful with one worker"""
+    session = HTTPSession(base_url)
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    session.connection.request('GET', '/metrics', headers=headers)
+    response = session.connection.getresponse()
+    if response.status != 200:
+        return None
+    totals = {}
+    for line in response.read().decode('utf-8').splitlines():
+        if line.startswith(('db_queries_per_request_sum ', 'db_queries_per_request_count ')):
+            key, value = line.split()
+            totals[key] = float(value)
+    return totals.get('db_queries_per_request_sum', 0), totals.get('db_queries_per_request_count', 0)
+
+
+def run_benchmark(args):
+    """Run every selected scenario and return the report dict"""
+    if args.url:
+        from database import get_pool
+
+        pool = get_pool()
+        with pool.connection() as conn:
+            usernames, blog_ids = load_targets(conn)
+        backend = pool.backend
+        make_session = lambda username: HTTPSession(args.url, username)
+        query_totals = lambda: _scraped_queries(args.url, os.environ.get('METRICS_TOKEN'))
+    else:
+        import app as blog_app
+
+        blog_app.app.config['SESSION_COOKIE_SECURE'] = False
+        with blog_app.db_pool.connection() as conn:
+            usernames, blog_ids = load_targets(conn)
+        backend = blog_app.db_pool.backend
+        make_session = lambda username: TestClientSession(blog_app.app, username)
+        query_totals = lambda: (_in_process_queries(blog_app.metrics) if blog_app.METRICS_ENABLED else None)
+
+    rng = random.Random(args.seed)
+    report = {
+        'meta': {
+            'mode': 'http' if args.url else 'test-client',
+            'url': args.url,
+            'backend': backend,
+            'concurrency': args.concurrency,
+            'requests_per_scenario': args.requests,
+            'anonymous': args.anonymous,
+            'seeded_users': len(usernames),
+            'seeded_blogs': len(blog_ids),
+            'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'python': sys.version.split()[0],
+        },
+        'scenarios': {},
+    }
+    # Likes always need a login; anonymous reads are mostly page-cache hits.
+    # Each user logs in once and the sessions of every scenario reuse it.
+    logins = []
+    if 'like' in args.scenarios or not args.anonymous:
+        login_names = rng.sample(usernames, min(MAX_LOGINS, args.concurrency, len(usernames)))
+        logins = [make_session(username) for username in login_names]
+    for name in args.scenarios:
+        if name == 'like' or not args.anonymous:
+            sessions = [logins[i % len(logins)].clone() for i in range(args.concurrency)]
+        else:
+            sessions = [make_session(None) for _ in range(args.concurrency)]
+        before = query_totals()
+        latencies, errors, wall = run_scenario(name, sessions, args.requests, args.warmup,
+                                               usernames, blog_ids, args.seed)
+        after = query_totals()
+        queries = None
+        if before and after and after[1] > before[1]:
+            # Includes the warmup requests, which run the same code paths
+            queries = (after[0] - before[0]) / (after[1] - before[1])
+        report['scenarios'][name] = summarize(latencies, errors, wall, queries)
+    return report
+
+
+def print_report(report):
+    print(f"{'scenario':<10} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}")
+    for name, stats in report['scenarios'].items():
+        queries = stats['queries_per_request']
+        print(f"{name:<10} {stats['requests_per_second']:>9} {stats['p50_ms']:>9} {stats['p90_ms']:>9} "
+              f"{stats['p99_ms']:>9} {queries if queries is not None else '-':>8} {stats['errors']:>7}")
+
+
+def compare_reports(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Print per-scenario changes; return the list of regressions"""
+    regressions = []
+    for key in ('mode', 'backend', 'concurrency', 'anonymous', 'seeded_blogs'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"Warning: {key} differs ({baseline['meta'].get(key)} vs {current['meta'].get(key)})")
+    print(f"{'scenario':<10} {'metric':<20} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, stats in current['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if not old:
+            continue
+        for metric, higher_is_worse in (('requests_per_second', False), ('p50_ms', True),
+                                        ('p90_ms', True), ('p99_ms', True), ('queries_per_request', True)):
+            before, after = old.get(metric), stats.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = change > threshold if higher_is_worse else change < -threshold
+            # Any extra query per request is a regression, whatever the timing noise
+            if metric == 'queries_per_request':
+                worse = after > before + 0.5
+            flag = '  REGRESSION' if worse else ''
+            print(f"{name:<10} {metric:<20} {before:>10} {after:>10} {change:>+8.0%}{flag}")
+            if worse:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed benchmark data and measure request performance')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='Insert a synthetic dataset')
+    seed_parser.add_argument('--users', type=int, default=200)
+    seed_parser.add_argument('--blogs', type=int, default=2000)
+    seed_parser.add_argument('--likes', type=int, default=10000)
+    seed_parser.add_argument('--comments', type=int, default=5000)
+    seed_parser.add_argument('--follows', type=int, default=3000)
+    seed_parser.add_argument('--notifications', type=int, default=5000)
+    seed_parser.add_argument('--seed', type=int, default=1)
+
+    run_parser = commands.add_parser('run', help='Drive the routes and report throughput and latency')
+    run_parser.add_argument('--url', help='Base URL of a running server (default: in-process test client)')
+    run_parser.add_argument('--concurrency', type=int, default=1)
+    run_parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+    run_parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per scenario')
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument('--anonymous', action='store_true', help='Read pages logged out (page cache hits)')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='Write the report as JSON to this file')
+    run_parser.add_argument('--compare', help='Baseline JSON report to compare against')
+    run_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    compare_parser = commands.add_parser('compare', help='Compare two saved JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'seed':
+        import app as blog_app
+
+        started = time.perf_counter()
+        with blog_app.db_pool.connection() as conn:
+            counts = seed(conn, blog_app.db_pool.backend, args.users, args.blogs, args.likes,
+                          args.comments, args.follows, args.notifications, args.seed)
+        print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s")
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return 1 if compare_reports(baseline, current, args.threshold) else 0
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare_reports(baseline, report, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache with per-entry expiry"""
+
+    def __init__(self, max_entries=1024, default_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Cache shared by every worker through Redis"""
+
+    def __init__(self, url, namespace, default_ttl=60):
+        import redis
+
+        self.default_ttl = default_ttl
+        self._client = redis.Redis.from_url(url)
+        self._prefix = f'blogapp:{namespace}:'
+
+    def get(self, key):
+        try:
+            raw = self._client.get(self._prefix + key)
+        except Exception as e:
+            print(f"Redis cache get failed: {e}")
+            return None
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            self._client.set(self._prefix + key, pickle.dumps(value), ex=ttl or None)
+        except Exception as e:
+            print(f"Redis cache set failed: {e}")
+
+    def delete(self, key):
+        try:
+            self._client.delete(self._prefix + key)
+        except Exception as e:
+            print(f"Redis cache delete failed: {e}")
+
+    def clear(self):
+        try:
+            keys = list(self._client.scan_iter(match=self._prefix + '*'))
+            if keys:
+                self._client.delete(*keys)
+        except Exception as e:
+            print(f"Redis cache clear failed: {e}")
+
+
+class FileSystemCache:
+    """Cache kept as files on disk, shared by every worker on the host"""
+
+    # Expired entries are swept every this many writes
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, directory, max_entries=5000, default_ttl=60):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at, value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Discarding unreadable cache file {path}: {e}")
+            self._remove(path)
+            return None
+        if expires_at is not None and expires_at <= time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        # Write to a temp file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires_at, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            print(f"File cache set failed: {e}")
+            self._remove(tmp_path)
+            return
+
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self._remove(os.path.join(self.directory, name))
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones beyond max_entries"""
+        now = time.time()
+        live = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    expires_at, _ = pickle.load(f)
+                mtime = os.path.getmtime(path)
+            except Exception:
+                continue
+            if expires_at is not None and expires_at <= now:
+                self._remove(path)
+            else:
+                live.append((mtime, path))
+
+        if len(live) > self.max_entries:
+            live.sort()
+            for _, path in live[:len(live) - self.max_entries]:
+                self._remove(path)
+
+
+def make_cache(namespace, max_entries=1024, default_ttl=60, backend=None):
+    """Create a cache for one namespace.
+
+    backend is 'memory', 'filesystem' or 'redis'; by default Redis is used
+    when CACHE_REDIS_URL is set and an in-process cache otherwise.
+    """
+    redis_url = os.environ.get('CACHE_REDIS_URL')
+    backend = backend or ('redis' if redis_url else 'memory')
+
+    if backend == 'redis':
+        return RedisCache(redis_url, namespace, default_ttl)
+    if backend == 'filesystem':
+        cache_dir = os.environ.get('CACHE_DIR', os.path.join('instance', 'cache'))
+        return FileSystemCache(os.path.join(cache_dir, namespace), max_entries, default_ttl)
+    return MemoryCache(max_entries, default_ttl)
@@ -0,0 +1,34 @@
+# Denormalized counters are maintained incrementally on every write; these
+# statements rebuild them from the source tables if they ever drift.
+RECONCILE_STATEMENTS = [
+    '''
+    UPDATE users SET
+        followers_count = (SELECT COUNT(*) FROM follows f WHERE f.following_username = users.username),
+        following_count = (SELECT COUNT(*) FROM follows f WHERE f.follower_username = users.username),
+        posts_count = (SELECT COUNT(*) FROM blogs b WHERE b.author_username = users.username)
+    ''',
+    '''
+    UPDATE blogs SET
+        likes_count = (SELECT COUNT(*) FROM likes l WHERE l.blog_id = blogs.id),
+        comments_count = (SELECT COUNT(*) FROM comments c WHERE c.blog_id = blogs.id)
+    ''',
+]
+
+
+def reconcile_counters(cursor):
+    """Recompute every denormalized user and blog counter from scratch"""
+    for statement in RECONCILE_STATEMENTS:
+        cursor.execute(statement)
+
+
+def reconcile_conversation_unread(cursor):
+    """Recompute each participant's unread message count per conversation"""
+    cursor.execute('''
+        UPDATE conversations SET
+            user1_unread = (SELECT COUNT(*) FROM messages m
+                            WHERE m.conversation_id = conversations.id
+                              AND m.receiver_username = conversations.user1_username AND m.is_read = FALSE),
+            user2_unread = (SELECT COUNT(*) FROM messages m
+                            WHERE m.conversation_id = conversations.id
+                              AND m.receiver_username = conversations.user2_username AND m.is_read = FALSE)
+    ''')
@@ -1,28 +1,349 @@
 import os
+import queue
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 from urllib.parse import urlparse
 
-def get_db_connection():
-    """Get database connection - PostgreSQL or SQLite"""
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+DB_FILE = 'blog_app.db'
+
+# Pool sizing - override with DB_POOL_SIZE / DB_POOL_TIMEOUT
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+# SQLite tuning, applied to every pooled connection. WAL lets readers keep
+# going while a writer commits; synchronous=NORMAL is durable across
+# application crashes in WAL mode and only loses the latest commits on power
+# loss. Negative cache_size is in KiB.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_KB', 16000)) * -1,
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_BYTES', 256 * 1024 * 1024)),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'temp_store': 'MEMORY',
+    # Checkpoint into the main file once the WAL reaches this many pages,
+    # and truncate it back to journal_size_limit bytes afterwards so a burst
+    # of writes does not leave a huge WAL behind
+    'wal_autocheckpoint': int(os.environ.get('SQLITE_WAL_AUTOCHECKPOINT', 1000)),
+    'journal_size_limit': 64 * 1024 * 1024,
+}
+# Seconds between background WAL checkpoints on SQLite; 0 turns them off
+WAL_CHECKPOINT_INTERVAL = int(os.environ.get('SQLITE_CHECKPOINT_INTERVAL', 300))
+
+# Rows fetched per round trip by server-side cursors
+STREAM_BATCH_SIZE = 2000
+
+# Catch these instead of sqlite3.Error so handlers work on either backend
+if psycopg2 is not None:
+    DB_ERRORS = (sqlite3.Error, psycopg2.Error)
+    INTEGRITY_ERRORS = (sqlite3.IntegrityError, psycopg2.IntegrityError)
+else:
+    DB_ERRORS = (sqlite3.Error,)
+    INTEGRITY_ERRORS = (sqlite3.IntegrityError,)
+
+
+def get_db_backend():
+    """Return the backend selected by DATABASE_URL - 'postgresql' or 'sqlite'"""
     database_url = os.environ.get('DATABASE_URL')
-    
     if database_url and database_url.startswith('postgresql'):
-        # PostgreSQL connection
-        import psycopg2
-        from psycopg2.extras import RealDictCursor
-        
+        return 'postgresql'
+    return 'sqlite'
+
+
+_QMARK_TOKENS = re.compile(r"'(?:[^']|'')*'|\?|%")
+
+
+@lru_cache(maxsize=512)
+def qmark_to_format(sql):
+    """Rewrite SQLite-style ? placeholders as psycopg2 %s placeholders.
+
+    Literal % signs are doubled and a ? inside a quoted string is kept. SQL that
+    has no ? placeholder is returned unchanged, so queries already written
+    with %s keep working.
+    """
+    tokens = _QMARK_TOKENS.findall(sql)
+    if '?' not in tokens:
+        return sql
+
+    def replace(match):
+        token = match.group()
+        if token == '?':
+            return '%s'
+        # psycopg2 interpolates the whole string, literals included
+        return token.replace('%', '%%')
+    return _QMARK_TOKENS.sub(replace, sql)
+
+
+if psycopg2 is not None:
+    class QmarkCursor(psycopg2.extensions.cursor):
+        """psycopg2 cursor accepting the same ? placeholders as sqlite3"""
+
+        def execute(self, query, vars=None):
+            return super().execute(qmark_to_format(query), vars)
+
+        def executemany(self, query, vars_list):
+            return super().executemany(qmark_to_format(query), vars_list)
+
+
+def get_db_connection(backend=None):
+    """Get database connection - PostgreSQL or SQLite"""
+    backend = backend or get_db_backend()
+
+    if backend == 'postgresql':
+        if psycopg2 is None:
+            raise RuntimeError("DATABASE_URL points at PostgreSQL but psycopg2 is not installed")
+
         # Parse URL
-        result = urlparse(database_url)
+        result = urlparse(os.environ.get('DATABASE_URL'))
         conn = psycopg2.connect(
             database=result.path[1:],
             user=result.username,
             password=result.password,
             host=result.hostname,
-            port=result.port
+            port=result.port,
+            cursor_factory=QmarkCursor
         )
         return conn, 'postgresql'
     else:
-        # SQLite fallback
-        conn = sqlite3.connect('blog_app.db')
+        # SQLite fallback - pooled connections are handed between threads,
+        # but only ever used by one request at a time
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False,
+                               timeout=SQLITE_PRAGMAS['busy_timeout'] / 1000)
         conn.row_factory = sqlite3.Row
+        configure_sqlite(conn)
         return conn, 'sqlite'
+
+
+def configure_sqlite(conn):
+    """Apply SQLITE_PRAGMAS to a new connection"""
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+
+
+def checkpoint_wal(conn, mode='TRUNCATE'):
+    """Copy the SQLite WAL back into the database file.
+
+    Automatic checkpoints are PASSIVE and give up while readers are active,
+    so a busy site can let the WAL grow; TRUNCATE waits for readers and
+    resets the WAL to zero bytes. Returns (busy, wal_pages, checkpointed).
+    """
+    return tuple(conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+
+class WalCheckpointer:
+    """Daemon thread checkpointing the SQLite WAL every interval seconds.
+
+    wal_autocheckpoint only runs on commit and stops short while readers are
+    active. This runs a PASSIVE checkpoint on a timer and, once that has
+    copied every page, a TRUNCATE that shrinks the WAL file to zero bytes.
+    """
+
+    def __init__(self, pool, interval=WAL_CHECKPOINT_INTERVAL):
+        self.pool = pool
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the checkpoint thread in this process (SQLite only)"""
+        if self.interval <= 0 or self.pool.backend != 'sqlite':
+            return
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='wal-checkpoint', daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Checkpoint once; returns (busy, wal_pages, checkpointed) of the PASSIVE pass"""
+        try:
+            with self.pool.connection() as conn:
+                result = checkpoint_wal(conn, 'PASSIVE')
+                busy, wal_pages, checkpointed = result
+                if not busy and wal_pages > 0 and checkpointed == wal_pages:
+                    # Nothing left to copy. Don't wait on readers: TRUNCATE
+                    # holds off writers while it waits, so retry next time
+                    conn.execute('PRAGMA busy_timeout = 0')
+                    try:
+                        checkpoint_wal(conn, 'TRUNCATE')
+                    finally:
+                        conn.execute(f"PRAGMA busy_timeout = {SQLITE_PRAGMAS['busy_timeout']}")
+            return result
+        except DB_ERRORS as e:
+            print(f"Error checkpointing WAL: {e}")
+            return None
+
+    def stop(self):
+        self._stop.set()
+
+
+def insert_returning_id(cursor, backend, sql, params=()):
+    """Run an INSERT and return the id of the new row"""
+    if backend == 'postgresql':
+        # lastrowid is an OID on PostgreSQL, not the serial id
+        cursor.execute(sql + ' RETURNING id', params)
+        return cursor.fetchone()[0]
+    cursor.execute(sql, params)
+    return cursor.lastrowid
+
+
+def streaming_cursor(conn, backend, name):
+    """Cursor for iterating large result sets without loading them at once.
+
+    On PostgreSQL this is a named (server-side) cursor that fetches
+    STREAM_BATCH_SIZE rows per round trip; sqlite3 cursors already step
+    through results lazily. Must be used inside a transaction.
+    """
+    if backend == 'postgresql':
+        cursor = conn.cursor(name=name)
+        cursor.itersize = STREAM_BATCH_SIZE
+        return cursor
+    return conn.cursor()
+
+
+def primary_key_column(backend):
+    """Column definition for an auto-incrementing integer id"""
+    if backend == 'postgresql':
+        return 'SERIAL PRIMARY KEY'
+    return 'INTEGER PRIMARY KEY AUTOINCREMENT'
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became available in time"""
+
+
+class ConnectionPool:
+    """Bounded pool of reusable database connections.
+
+    At most ``max_size`` connections are ever checked out at once; idle
+    connections are kept and handed out again instead of reconnecting.
+    """
+
+    def __init__(self, backend, max_size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.backend = backend
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        # Optional callable(conn, opened) that may wrap checked-out connections
+        self.instrument = None
+
+    def _connect(self):
+        conn, _ = get_db_connection(self.backend)
+        return conn
+
+    def _is_usable(self, conn):
+        if self.backend == 'postgresql':
+            return not conn.closed
+        return True
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if none is idle"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No {self.backend} connection available after {self.timeout}s")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._checkout(self._connect(), True)
+                if self._is_usable(conn):
+                    return self._checkout(conn, False)
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkout(self, conn, opened):
+        if self.instrument is None:
+            return conn
+        return self.instrument(conn, opened)
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any open transaction"""
+        # Unwrap connections handed out through self.instrument
+        conn = getattr(conn, 'wrapped', conn)
+        try:
+            conn.rollback()
+        except Exception as e:
+            print(f"Discarding broken {self.backend} connection: {e}")
+            self._close(conn)
+        else:
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a ``with`` block"""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def reset_after_fork(self):
+        """Forget connections inherited from the parent process.
+
+        They are not closed: closing a PostgreSQL connection sends a terminate
+        message over the socket the parent is still using. References are
+        kept so garbage collection cannot close them either.
+        """
+        while True:
+            try:
+                _inherited_connections.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        self._slots = threading.BoundedSemaphore(self.max_size)
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_inherited_connections = []
+
+
+def get_pool(backend=None):
+    """Return the process-wide pool for a backend, creating it on first use"""
+    backend = backend or get_db_backend()
+    with _pools_lock:
+        pool = _pools.get(backend)
+        if pool is None:
+            pool = _pools[backend] = ConnectionPool(backend)
+        return pool
+
+
+def reset_pools_after_fork():
+    """Give a forked gunicorn worker its own empty pools.
+
+    preload_app imports the app (and opens connections) in the master; this
+    runs in each worker from the post_worker_init hook.
+    """
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        pool.reset_after_fork()
@@ -0,0 +1,146 @@
+import json
+import os
+import queue
+import threading
+
+# Events a slow client may have waiting before newer ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class Subscription:
+    """One connected client's view of a set of channels"""
+
+    def __init__(self, hub, channels):
+        self.hub = hub
+        self.channels = set(channels)
+        self._queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event, data):
+        try:
+            self._queue.put_nowait((event, data))
+        except queue.Full:
+            # The browser re-syncs on reconnect; never block a publisher
+            pass
+
+    def get(self, timeout=None):
+        """Next (event, data) pair, or None if nothing arrived within timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class EventHub:
+    """In-process publish/subscribe for pushing events to open SSE streams.
+
+    Without a broker, events only reach clients connected to this process.
+    With a broker (see RedisBroker) publish() goes through it and every
+    worker's hub delivers what the broker relays back.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start relaying broker events to this process's streams"""
+        if self.broker is not None:
+            self.broker.start(self.deliver)
+
+    def reset_after_fork(self):
+        """Drop the parent's subscribers - their streams are not ours to serve"""
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        if self.broker is not None:
+            self.broker.reset_after_fork()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, event, data):
+        """Send an event to everyone subscribed to channel"""
+        if self.broker is not None:
+            try:
+                self.broker.publish(channel, event, data)
+                return
+            except Exception as e:
+                print(f"Event broker publish failed, delivering locally: {e}")
+        self.deliver(channel, event, data)
+
+    def deliver(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(event, data)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({s for subscribers in self._subscribers.values() for s in subscribers})
+
+
+class RedisBroker:
+    """Relays events between workers over Redis pub/sub"""
+
+    def __init__(self, url, prefix='blogapp:events:'):
+        import redis
+
+        self._url = url
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._deliver = None
+
+    def start(self, deliver):
+        self._deliver = deliver
+        threading.Thread(target=self._listen, name='event-broker', daemon=True).start()
+
+    def reset_after_fork(self):
+        # The parent's socket is not ours to use
+        import redis
+
+        self._client = redis.Redis.from_url(self._url)
+
+    def publish(self, channel, event, data):
+        self._client.publish(self._prefix + channel, json.dumps([event, data]))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self._prefix + '*')
+                for message in pubsub.listen():
+                    channel = message['channel'].decode('utf-8')[len(self._prefix):]
+                    event, data = json.loads(message['data'])
+                    self._deliver(channel, event, data)
+            except Exception as e:
+                print(f"Event broker connection lost, reconnecting: {e}")
+                threading.Event().wait(1)
+
+
+def make_event_hub():
+    """Create the event hub, relaying through Redis when EVENTS_REDIS_URL is set"""
+    redis_url = os.environ.get('EVENTS_REDIS_URL') or os.environ.get('CACHE_REDIS_URL')
+    if redis_url:
+        return EventHub(RedisBroker(redis_url))
+    return EventHub()
+
+
+def format_sse(event, data):
+    """Encode one Server-Sent Events message"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
@@ -1,2 +1,53 @@
-bind = "0.0.0.0:10000"
-workers = 1
\ No newline at end of file
+import os
+
+# Worker class: gthread (default) or gevent. gevent needs the gevent package
+# installed and psycogreen for non-blocking PostgreSQL access.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Patch before preload_app imports the app: locks, queues and semaphores
+    # created in the master must be gevent ones, or a worker waiting on the
+    # connection pool blocks the whole hub instead of one greenlet
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        print("psycogreen not installed - PostgreSQL calls will block the gevent loop")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# CPUs this process may run on. Unlike cpu_count(), the affinity mask reflects
+# a container's CPU pinning rather than every core of the host.
+if hasattr(os, 'sched_getaffinity'):
+    cpu_count = len(os.sched_getaffinity(0))
+else:
+    cpu_count = os.cpu_count() or 1
+workers = int(os.environ.get('WEB_CONCURRENCY', cpu_count * 2 + 1))
+
+if worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+elif worker_class == 'gevent':
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Import the app once in the master so workers fork with it already loaded.
+# init_db() and migrations run once here; post_worker_init below drops the
+# connections and queues each worker inherits from the master.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# Recycle workers gradually to cap slow memory growth; jitter keeps them from
+# all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# Uploads of up to 16MB need headroom on slow connections
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+
+def post_worker_init(worker):
+    # Runs in each worker once the app is loaded, whether or not it was preloaded
+    from app import init_worker
+    init_worker()
@@ -0,0 +1,189 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+def available_cpus():
+    """CPUs this process may run on (the affinity mask, as gunicorn_config uses)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Every web worker has its own hashing pool and limits, so both multiply by
+# the number of web workers. gunicorn_config defaults to 2 x CPUs + 1 of them.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', available_cpus() * 2 + 1))
+# Processes computing password hashes per web worker; 0 hashes on the request
+# thread. The default splits the CPUs between the web workers, at least one each.
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', max(1, available_cpus() // WEB_CONCURRENCY)))
+# Hashes running or waiting per web worker before new ones are refused
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', 4))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+
+# Password attempts allowed per client IP, and per username from one client
+# IP, in each window
+ATTEMPTS_PER_IP = int(os.environ.get('AUTH_ATTEMPTS_PER_IP', 20))
+ATTEMPTS_PER_USER = int(os.environ.get('AUTH_ATTEMPTS_PER_USER', 10))
+ATTEMPT_WINDOW_SECONDS = 60
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full"""
+
+
+class TooManyAttempts(Exception):
+    """Raised when a client or account has used up its password attempts"""
+
+
+class AttemptLimiter:
+    """Sliding-window attempt counter per key, kept in process memory"""
+
+    def __init__(self, limit, window=ATTEMPT_WINDOW_SECONDS, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Record an attempt for key; False if it is over the limit"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            self._attempts.move_to_end(key)
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return False
+            attempts.append(now)
+            while len(self._attempts) > self.max_keys:
+                self._attempts.popitem(last=False)
+            return True
+
+    def clear(self, key):
+        """Forget the attempts recorded for key"""
+        with self._lock:
+            self._attempts.pop(key, None)
+
+
+class PasswordHasher:
+    """Runs the slow password KDF in a process pool with bounded admission.
+
+    A burst of login attempts can then only queue HASH_MAX_PENDING hashes
+    per web worker; beyond that requests are refused instead of pinning
+    every thread on PBKDF2/scrypt while the rest of the site waits. The pool
+    and limits are per web worker, so server-wide they are WEB_CONCURRENCY
+    times larger.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.ip_limiter = AttemptLimiter(ATTEMPTS_PER_IP)
+        self.user_limiter = AttemptLimiter(ATTEMPTS_PER_USER)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def reset_after_fork(self):
+        # The parent's pool processes belong to the parent
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Forked from a clean server process rather than from this
+                # threaded web worker, so hashing processes inherit none of
+                # the app's connections, locks or threads. The server only
+                # preloads the hashing code, not the entry script.
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['werkzeug.security'])
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            return self._executor
+
+    def _discard_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, func, *args, **kwargs):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashingBusy("Too many password hashes in progress")
+        if self.workers <= 0:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                slots.release()
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except Exception:
+            slots.release()
+            raise
+        # The slot is held until the hash is done, not until this request
+        # gives up on it, so abandoned hashes still count against the limit
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool as e:
+            # A hashing process died; start a fresh pool for the next caller
+            print(f"Password hashing pool broken, restarting: {e}")
+            self._discard_executor(executor)
+            raise HashingBusy("Password hashing pool restarting")
+        except TimeoutError:
+            # Drop it if it has not started yet
+            future.cancel()
+            raise HashingBusy(f"Password hash took longer than {self.timeout}s")
+
+    def admit(self, client_ip, username=None):
+        """Count a password attempt, raising TooManyAttempts over the limits.
+
+        The username limit is kept per client IP, so guesses from elsewhere
+        cannot lock the account's owner out.
+        """
+        if client_ip and not self.ip_limiter.allow(client_ip):
+            raise TooManyAttempts(f"Too many attempts from {client_ip}")
+        if username and not self.user_limiter.allow((username.lower(), client_ip)):
+            raise TooManyAttempts(f"Too many attempts for {username}")
+
+    def record_success(self, client_ip, username):
+        """Clear the username's attempts from client_ip after a correct password"""
+        self.user_limiter.clear((username.lower(), client_ip))
+
+    def hash(self, password, **options):
+        """generate_password_hash() in the pool; options are passed through"""
+        return self._run(generate_password_hash, password, **options)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+def token_digest(token):
+    """SHA-256 hex digest of a high-entropy token.
+
+    Reset tokens are long random signed strings, so a fast hash is enough to
+    keep them out of the database in usable form; a slow KDF only matters for
+    low-entropy secrets like passwords.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
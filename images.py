@@ -0,0 +1,121 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Widths generated for srcset; a variant is only made when it is smaller
+# than the original image
+VARIANT_WIDTHS = (320, 640, 1280)
+
+# Output formats in order of preference - AVIF is skipped when this Pillow
+# build cannot encode it
+VARIANT_FORMATS = {
+    'avif': {'quality': 50},
+    'webp': {'quality': 80, 'method': 4},
+}
+
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+
+
+def _supported_formats():
+    try:
+        from PIL import Image, features
+    except ImportError:
+        return []
+    Image.init()
+    supported = []
+    for fmt in VARIANT_FORMATS:
+        if fmt.upper() in Image.SAVE and (fmt != 'webp' or features.check('webp')):
+            supported.append(fmt)
+    return supported
+
+
+def variant_name(filename, width, fmt):
+    """Name of the resized copy of an upload, e.g. abc_photo-640w.webp"""
+    stem = filename.rsplit('.', 1)[0]
+    return f'{stem}-{width}w.{fmt}'
+
+
+def generate_variants(upload_folder, filename, formats):
+    """Write resized copies of one upload and return {format: [[width, name], ...]}"""
+    from PIL import Image, ImageOps
+
+    variants = {fmt: [] for fmt in formats}
+    with Image.open(os.path.join(upload_folder, filename)) as original:
+        # Animated GIFs would lose their animation - leave them as they are
+        if getattr(original, 'is_animated', False):
+            return {}
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        for width in VARIANT_WIDTHS:
+            if width >= image.width:
+                break
+            # Uploads are content-addressed, so an existing variant of a
+            # re-uploaded image is already correct
+            missing = [fmt for fmt in formats
+                       if not os.path.exists(os.path.join(upload_folder, variant_name(filename, width, fmt)))]
+            if missing:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS)
+                for fmt in missing:
+                    path = os.path.join(upload_folder, variant_name(filename, width, fmt))
+                    resized.save(path, fmt.upper(), **VARIANT_FORMATS[fmt])
+            for fmt in formats:
+                variants[fmt].append([width, variant_name(filename, width, fmt)])
+    return {fmt: sizes for fmt, sizes in variants.items() if sizes}
+
+
+class ImagePipeline:
+    """Generates responsive image variants for uploads on background threads"""
+
+    def __init__(self, upload_folder, on_complete, max_workers=IMAGE_WORKERS):
+        self.upload_folder = upload_folder
+        self.on_complete = on_complete
+        self.max_workers = max_workers
+        self.formats = _supported_formats()
+        self._executor = None
+        self._lock = threading.Lock()
+        if not self.formats:
+            print("Pillow not available - uploads are served without resized variants")
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='image-pipeline')
+            return self._executor
+
+    def submit(self, blog_id, filenames):
+        """Queue variant generation for a blog's uploaded images"""
+        if not self.formats or not filenames:
+            return None
+        return self._get_executor().submit(self._process, blog_id, list(filenames))
+
+    def _process(self, blog_id, filenames):
+        variants = {}
+        for filename in filenames:
+            try:
+                file_variants = generate_variants(self.upload_folder, filename, self.formats)
+            except Exception as e:
+                print(f"Error generating variants for {filename}: {e}")
+                continue
+            if file_variants:
+                variants[filename] = file_variants
+        if variants:
+            try:
+                self.on_complete(blog_id, variants)
+            except Exception as e:
+                print(f"Error recording image variants for blog {blog_id}: {e}")
+        return variants
+
+    def reset_after_fork(self):
+        """Drop the executor inherited from the parent - its threads did not survive"""
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
@@ -0,0 +1,136 @@
+import glob
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+# Equivalent extensions share one canonical spelling so identical bytes
+# always map to the same file name
+_EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the allowed size while streaming"""
+
+
+def _extension(filename):
+    ext = filename.rsplit('.', 1)[1].lower()
+    return _EXTENSION_ALIASES.get(ext, ext)
+
+
+def save_upload(file, upload_folder, max_bytes):
+    """Stream an upload to disk, hashing it on the way, and store it by content.
+
+    Returns (filename, staged_path) where filename is "<sha256>.<ext>". When
+    identical bytes were already stored, staged_path is a temporary copy that
+    settle_uploads() moves into place once the new reference is committed;
+    otherwise it is None and the file was created.
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"{file.filename} exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+
+        filename = f'{digest.hexdigest()}.{_extension(file.filename)}'
+        final_path = os.path.join(upload_folder, filename)
+        if os.path.exists(final_path):
+            # Keep the bytes: the blog deleting the last other reference may
+            # remove the stored file before this upload's reference commits
+            return filename, tmp_path
+        os.replace(tmp_path, final_path)
+        return filename, None
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def settle_uploads(upload_folder, staged):
+    """Put staged copies in place once their references are committed.
+
+    staged is a list of (filename, staged_path) from save_upload(). The copy
+    always replaces the stored file - the bytes are identical - so a file
+    removed by a concurrent delete is restored.
+    """
+    for filename, staged_path in staged:
+        try:
+            os.replace(staged_path, os.path.join(upload_folder, filename))
+        except OSError as e:
+            print(f"Error settling upload {filename}: {e}")
+
+
+def discard_staged(staged):
+    """Remove staged copies of uploads whose blog was not created"""
+    for _, staged_path in staged:
+        try:
+            os.remove(staged_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing staged upload {staged_path}: {e}")
+
+
+def acquire_media(cursor, upload_folder, filenames):
+    """Add one reference to each stored file, registering new ones"""
+    for filename in filenames:
+        try:
+            size = os.path.getsize(os.path.join(upload_folder, filename))
+        except OSError:
+            size = None
+        cursor.execute('''
+            INSERT INTO media (filename, sha256, size_bytes, ref_count)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT (filename) DO UPDATE SET ref_count = media.ref_count + 1
+        ''', (filename, filename.rsplit('.', 1)[0], size))
+
+
+def release_media(cursor, filenames):
+    """Drop one reference to each file; return the ones nothing refers to now"""
+    orphans = []
+    for filename in filenames:
+        cursor.execute('UPDATE media SET ref_count = ref_count - 1 WHERE filename = ?', (filename,))
+        if not cursor.rowcount:
+            # Uploads from before content addressing are not tracked
+            continue
+        cursor.execute('DELETE FROM media WHERE filename = ? AND ref_count <= 0', (filename,))
+        if cursor.rowcount:
+            orphans.append(filename)
+    return orphans
+
+
+def unreferenced_media(cursor, filenames):
+    """The filenames no media row refers to, e.g. after a concurrent upload re-took one"""
+    if not filenames:
+        return []
+    placeholders = ', '.join('?' for _ in filenames)
+    cursor.execute(f'SELECT filename FROM media WHERE filename IN ({placeholders})', list(filenames))
+    referenced = {row[0] for row in cursor.fetchall()}
+    return [filename for filename in filenames if filename not in referenced]
+
+
+def remove_media_files(upload_folder, filenames):
+    """Delete stored files and their resized variants - call after commit"""
+    for filename in filenames:
+        stem = filename.rsplit('.', 1)[0]
+        paths = [os.path.join(upload_folder, filename)]
+        paths += glob.glob(os.path.join(upload_folder, glob.escape(stem) + '-*w.*'))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing media file {path}: {e}")
@@ -0,0 +1,205 @@
+import os
+import re
+import threading
+import time
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the queries/connections per request histogram buckets
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Statements slower than this are printed with their duration
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+_WHITESPACE = re.compile(r'\s+')
+_IN_LIST = re.compile(r'IN \((?:\?|%s)(?:, (?:\?|%s))*\)', re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Collapse a statement to one line so its variants share one label"""
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('IN (...)', sql)[:300]
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Per-process request and database statistics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.request_latency = {}
+        self.queries_per_request = Histogram(COUNT_BUCKETS)
+        self.connections_per_request = Histogram(COUNT_BUCKETS)
+        self.connections_opened = 0
+        # normalized SQL -> [count, total seconds, max seconds]
+        self.statements = {}
+
+    # Request hooks
+    def start_request(self):
+        self._local.request = {'started': time.perf_counter(), 'queries': 0, 'connections': 0}
+
+    def end_request(self, method, endpoint, status):
+        stats = getattr(self._local, 'request', None)
+        if stats is None:
+            return
+        self._local.request = None
+        elapsed = time.perf_counter() - stats['started']
+        key = (method, endpoint, str(status))
+        with self._lock:
+            histogram = self.request_latency.get(key)
+            if histogram is None:
+                histogram = self.request_latency[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+            self.queries_per_request.observe(stats['queries'])
+            self.connections_per_request.observe(stats['connections'])
+
+    # Database hooks
+    def wrap_connection(self, conn, opened=False):
+        """Instrument a connection handed out by the pool (ConnectionPool.instrument)"""
+        stats = getattr(self._local, 'request', None)
+        if stats is not None:
+            stats['connections'] += 1
+        if opened:
+            with self._lock:
+                self.connections_opened += 1
+        return InstrumentedConnection(conn, self)
+
+    def record_query(self, sql, elapsed):
+        statement = normalize_sql(sql)
+        stats = getattr(self._local, 'request', None)
+        if stats is not None:
+            stats['queries'] += 1
+        with self._lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                entry = self.statements[statement] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            print(f"Slow query ({elapsed * 1000:.1f} ms): {statement}")
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines.append('# HELP http_request_duration_seconds Request latency by route')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (method, endpoint, status), histogram in sorted(self.request_latency.items()):
+                labels = f'method="{_escape(method)}",endpoint="{_escape(endpoint)}",status="{status}"'
+                lines.extend(_histogram_lines('http_request_duration_seconds', labels, histogram))
+
+            for name, help_text, histogram in (
+                ('db_queries_per_request', 'SQL statements executed per request', self.queries_per_request),
+                ('db_connections_per_request', 'Pooled connections checked out per request', self.connections_per_request),
+            ):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                lines.extend(_histogram_lines(name, '', histogram))
+
+            lines.append('# HELP db_connections_opened_total New database connections opened by the pool')
+            lines.append('# TYPE db_connections_opened_total counter')
+            lines.append(f'db_connections_opened_total {self.connections_opened}')
+
+            lines.append('# HELP db_statement_calls_total Executions per SQL statement')
+            lines.append('# TYPE db_statement_calls_total counter')
+            for statement, (count, _, _) in sorted(self.statements.items()):
+                lines.append(f'db_statement_calls_total{{statement="{_escape(statement)}"}} {count}')
+            lines.append('# HELP db_statement_seconds_total Time spent per SQL statement')
+            lines.append('# TYPE db_statement_seconds_total counter')
+            for statement, (_, total, _) in sorted(self.statements.items()):
+                lines.append(f'db_statement_seconds_total{{statement="{_escape(statement)}"}} {total:.6f}')
+            lines.append('# HELP db_statement_max_seconds Slowest execution per SQL statement')
+            lines.append('# TYPE db_statement_max_seconds gauge')
+            for statement, (_, _, slowest) in sorted(self.statements.items()):
+                lines.append(f'db_statement_max_seconds{{statement="{_escape(statement)}"}} {slowest:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, labels, histogram):
+    prefix = labels + ',' if labels else ''
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        yield f'{name}_bucket{{{prefix}le="{bound}"}} {count}'
+    yield f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}'
+    suffix = f'{{{labels}}}' if labels else ''
+    yield f'{name}_sum{suffix} {histogram.total:.6f}'
+    yield f'{name}_count{suffix} {histogram.count}'
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times every statement it executes"""
+
+    def __init__(self, cursor, metrics):
+        object.__setattr__(self, 'wrapped', cursor)
+        object.__setattr__(self, '_metrics', metrics)
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            self.wrapped.execute(sql, params)
+        finally:
+            self._metrics.record_query(sql, time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, params_seq):
+        started = time.perf_counter()
+        try:
+            self.wrapped.executemany(sql, params_seq)
+        finally:
+            self._metrics.record_query(sql, time.perf_counter() - started)
+        return self
+
+    def __iter__(self):
+        return iter(self.wrapped)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def __setattr__(self, name, value):
+        # e.g. itersize on PostgreSQL server-side cursors
+        setattr(self.wrapped, name, value)
+
+
+class InstrumentedConnection:
+    """Connection proxy whose cursors are instrumented"""
+
+    def __init__(self, conn, metrics):
+        self.wrapped = conn
+        self._metrics = metrics
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.wrapped.cursor(*args, **kwargs), self._metrics)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def __enter__(self):
+        self.wrapped.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.wrapped.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
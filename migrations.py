@@ -0,0 +1,237 @@
+"""Versioned schema migrations.
+
+Each entry in MIGRATIONS is (version, description, steps) where steps is a
+list of SQL statements or callables taking (cursor, backend). Versions are
+applied in order, each in its own transaction, and recorded in the
+schema_version table so they only ever run once per database.
+"""
+
+import json
+import os
+
+from counters import reconcile_counters, reconcile_conversation_unread
+
+# Accounts from before the users table, keyed by username
+LEGACY_USERS_FILE = 'users.json'
+
+
+def import_legacy_users(cursor, backend, path=LEGACY_USERS_FILE):
+    """Copy accounts from the legacy users.json into the users table.
+
+    Usernames that already exist are left alone, so it is safe to re-run.
+    An unreadable file or malformed entries are skipped rather than failing
+    the migration. Returns the number of accounts imported.
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, 'r') as f:
+            users = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading legacy users from {path}: {e}")
+        return 0
+    if not isinstance(users, dict):
+        print(f"Error reading legacy users from {path}: expected an object keyed by username")
+        return 0
+
+    p = _placeholder(backend)
+    imported = 0
+    for username, data in users.items():
+        if not isinstance(data, dict):
+            print(f"Skipping malformed legacy user entry {username!r}")
+            continue
+        cursor.execute(f'''
+            INSERT INTO users (username, email, password_hash, channel, created_at)
+            VALUES ({p}, {p}, {p}, {p}, COALESCE({p}, CURRENT_TIMESTAMP))
+            ON CONFLICT (username) DO NOTHING
+        ''', (username, data.get('email', ''), data.get('password'), data.get('channel') or 'general',
+              data.get('created_at')))
+        imported += cursor.rowcount
+    if imported:
+        print(f"Imported {imported} accounts from {path}")
+    return imported
+
+
+def _reconcile_counters(cursor, backend):
+    reconcile_counters(cursor)
+
+
+def _reconcile_conversation_unread(cursor, backend):
+    reconcile_conversation_unread(cursor)
+
+
+def _link_messages_to_conversations(cursor, backend):
+    """Give every pair that has exchanged messages a conversation row and
+    point their messages at it.
+
+    The pair is sorted in Python, as send_message() does, rather than with
+    SQL string comparison, which follows the database collation.
+    """
+    p = _placeholder(backend)
+    cursor.execute('SELECT DISTINCT sender_username, receiver_username FROM messages')
+    pairs = {tuple(sorted((row[0], row[1]))) for row in cursor.fetchall()}
+    for user1, user2 in sorted(pairs):
+        cursor.execute(f'''
+            INSERT INTO conversations (user1_username, user2_username) VALUES ({p}, {p})
+            ON CONFLICT (user1_username, user2_username) DO NOTHING
+        ''', (user1, user2))
+        cursor.execute(f'''
+            UPDATE messages SET conversation_id = (
+                SELECT id FROM conversations WHERE user1_username = {p} AND user2_username = {p}
+            )
+            WHERE (sender_username = {p} AND receiver_username = {p})
+               OR (sender_username = {p} AND receiver_username = {p})
+        ''', (user1, user2, user1, user2, user2, user1))
+
+
+MIGRATIONS = [
+    (1, 'Indexes for hot lookup columns', [
+        # Profile pages and the home feed
+        'CREATE INDEX IF NOT EXISTS idx_blogs_author_created ON blogs (author_username, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_blogs_created_id ON blogs (created_at, id)',
+        # Per-post like/comment counts and comment lists. likes(blog_id) is
+        # already covered by the UNIQUE(blog_id, username) index.
+        'CREATE INDEX IF NOT EXISTS idx_comments_blog_created ON comments (blog_id, created_at)',
+        # Follower counts; follower-side lookups use UNIQUE(follower, following)
+        'CREATE INDEX IF NOT EXISTS idx_follows_following ON follows (following_username, follower_username)',
+        # Notification badge and notification list
+        'CREATE INDEX IF NOT EXISTS idx_notifications_user_read ON notifications (user_username, is_read)',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications (user_username, created_at)',
+        # Conversation threads and unread messages
+        'CREATE INDEX IF NOT EXISTS idx_messages_pair_created ON messages (sender_username, receiver_username, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_receiver_read ON messages (receiver_username, is_read)',
+    ]),
+    (2, 'Denormalized like and comment counters on blogs', [
+        'ALTER TABLE blogs ADD COLUMN likes_count INTEGER DEFAULT 0',
+        'ALTER TABLE blogs ADD COLUMN comments_count INTEGER DEFAULT 0',
+        _reconcile_counters,
+    ]),
+    (3, 'Track when blogs were last modified', [
+        'ALTER TABLE blogs ADD COLUMN updated_at TIMESTAMP',
+        'UPDATE blogs SET updated_at = created_at',
+    ]),
+    (4, 'Responsive image variants for blog uploads', [
+        "ALTER TABLE blogs ADD COLUMN image_variants TEXT DEFAULT '{}'",
+    ]),
+    (5, 'Content-addressed media with reference counts', [
+        '''
+        CREATE TABLE IF NOT EXISTS media (
+            filename TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size_bytes INTEGER,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (6, 'Materialized follower timelines', [
+        # One row per (reader, blog); created_at is copied from the blog so a
+        # timeline page is a single index range scan
+        '''
+        CREATE TABLE IF NOT EXISTS timeline (
+            username TEXT NOT NULL,
+            blog_id INTEGER NOT NULL,
+            author_username TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (username, blog_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_timeline_user_created ON timeline (username, created_at, blog_id)',
+        'CREATE INDEX IF NOT EXISTS idx_timeline_blog ON timeline (blog_id)',
+        # Backfill: every author's own posts, then their followers' copies
+        '''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT author_username, id, author_username, created_at FROM blogs
+        ''',
+        '''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT f.follower_username, b.id, b.author_username, b.created_at
+        FROM follows f JOIN blogs b ON b.author_username = f.following_username
+        WHERE f.follower_username != b.author_username
+        ''',
+    ]),
+    (7, 'Conversation key and unread counters for messages', [
+        'ALTER TABLE messages ADD COLUMN conversation_id INTEGER',
+        'ALTER TABLE conversations ADD COLUMN user1_unread INTEGER DEFAULT 0',
+        'ALTER TABLE conversations ADD COLUMN user2_unread INTEGER DEFAULT 0',
+        _link_messages_to_conversations,
+        '''
+        UPDATE conversations SET last_message_id = (
+            SELECT MAX(m.id) FROM messages m WHERE m.conversation_id = conversations.id
+        )
+        ''',
+        _reconcile_conversation_unread,
+        # A thread page and the inbox are each one index range scan
+        'CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_conversations_user1_updated ON conversations (user1_username, updated_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_conversations_user2_updated ON conversations (user2_username, updated_at, id)',
+    ]),
+    (8, 'Import legacy users.json accounts', [
+        import_legacy_users,
+    ]),
+    (9, 'Indexed SHA-256 digests for password reset tokens', [
+        # Rows from before this stored salted KDF hashes, which can never be
+        # found by digest - retire them
+        'UPDATE password_reset_tokens SET used_at = CURRENT_TIMESTAMP WHERE used_at IS NULL AND length(token_hash) != 64',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_reset_tokens_hash ON password_reset_tokens (token_hash)',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_username ON password_reset_tokens (username, used_at)',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_expires ON password_reset_tokens (expires_at)',
+    ]),
+]
+
+
+def _placeholder(backend):
+    return '%s' if backend == 'postgresql' else '?'
+
+
+def _begin_locked(conn, cursor, backend):
+    """Start a transaction that holds the schema write lock"""
+    if backend == 'postgresql':
+        cursor.execute('LOCK TABLE schema_version IN EXCLUSIVE MODE')
+    else:
+        if conn.in_transaction:
+            conn.commit()
+        cursor.execute('BEGIN IMMEDIATE')
+
+
+def get_schema_version(cursor):
+    """Return the highest applied migration version, or 0"""
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    row = cursor.fetchone()
+    return row[0] or 0
+
+
+def run_migrations(conn, backend):
+    """Apply every pending migration in order"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    for version, description, steps in MIGRATIONS:
+        # Re-check under the lock - another worker may have applied it
+        _begin_locked(conn, cursor, backend)
+        if get_schema_version(cursor) >= version:
+            conn.commit()
+            continue
+
+        try:
+            for step in steps:
+                if callable(step):
+                    step(cursor, backend)
+                else:
+                    cursor.execute(step)
+            cursor.execute(
+                f'INSERT INTO schema_version (version, description) VALUES ({_placeholder(backend)}, {_placeholder(backend)})',
+                (version, description)
+            )
+            conn.commit()
+            print(f"Applied migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            raise
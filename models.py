@@ -0,0 +1,139 @@
+"""Records for rows read from the database.
+
+Each record class maps result columns to its attributes by column name.
+The mapping is compiled into a small constructor function once per cursor
+description, so turning a page of rows into records costs one attribute
+store per field instead of a dict built and JSON decoded per row.
+"""
+
+import json
+from functools import lru_cache
+
+_UNSET = object()
+
+
+def load_json_column(value, default):
+    """Parse a JSON text column, falling back to default if empty or invalid"""
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except (json.JSONDecodeError, TypeError):
+        return default
+
+
+@lru_cache(maxsize=256)
+def _compile_row_factory(cls, columns):
+    """Build a function turning a row with these columns into a cls record"""
+    assigned = {}
+    for index, column in enumerate(columns):
+        attribute = cls.aliases.get(column, column)
+        if attribute in cls.__slots__ and attribute not in assigned:
+            assigned[attribute] = index
+
+    lines = ['def make(row):', '    record = new(cls)']
+    for attribute in cls.__slots__:
+        if attribute in assigned:
+            lines.append(f'    record.{attribute} = row[{assigned[attribute]}]')
+        elif attribute.startswith('_'):
+            lines.append(f'    record.{attribute} = unset')
+        else:
+            lines.append(f'    record.{attribute} = None')
+    lines.append('    return record')
+
+    namespace = {'new': object.__new__, 'cls': cls, 'unset': _UNSET}
+    exec('\n'.join(lines), namespace)
+    return namespace['make']
+
+
+class Record:
+    """Base for slot-based row records"""
+
+    __slots__ = ()
+    # Column name -> attribute name, for columns whose names differ
+    aliases = {}
+    # Attributes included in to_dict(); defaults to every public slot
+    exported = None
+
+    def __init__(self, **fields):
+        for attribute in self.__slots__:
+            default = _UNSET if attribute.startswith('_') else None
+            setattr(self, attribute, fields.pop(attribute, default))
+        if fields:
+            raise TypeError(f"Unknown {type(self).__name__} fields: {', '.join(fields)}")
+
+    @classmethod
+    def row_factory(cls, description):
+        """Constructor for rows described by a DB-API cursor.description"""
+        return _compile_row_factory(cls, tuple(column[0].lower() for column in description))
+
+    @classmethod
+    def fetch_all(cls, cursor):
+        """All remaining rows of an executed cursor as records"""
+        rows = cursor.fetchall()
+        if not rows:
+            return []
+        make = cls.row_factory(cursor.description)
+        return [make(row) for row in rows]
+
+    @classmethod
+    def fetch_one(cls, cursor):
+        """The next row of an executed cursor as a record, or None"""
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return cls.row_factory(cursor.description)(row)
+
+    def to_dict(self):
+        names = self.exported or [name for name in self.__slots__ if not name.startswith('_')]
+        return {name: getattr(self, name) for name in names}
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {getattr(self, "id", None)}>'
+
+
+class Blog(Record):
+    __slots__ = ('id', 'title', 'content', 'author', 'channel', 'date', 'likes', 'comments', 'snippet',
+                 '_images_json', '_image_variants_json', '_images', '_image_variants')
+    aliases = {
+        'author_username': 'author',
+        'created_at': 'date',
+        'likes_count': 'likes',
+        'comments_count': 'comments',
+        'images': '_images_json',
+        'image_variants': '_image_variants_json',
+    }
+    exported = ('id', 'title', 'content', 'author', 'channel', 'date', 'images', 'likes', 'comments',
+                'image_variants')
+
+    @property
+    def images(self):
+        """Uploaded image filenames, decoded on first access"""
+        if self._images is _UNSET:
+            raw = self._images_json
+            self._images = load_json_column(None if raw is _UNSET else raw, [])
+        return self._images
+
+    @property
+    def image_variants(self):
+        """Responsive variants per image filename, decoded on first access"""
+        if self._image_variants is _UNSET:
+            raw = self._image_variants_json
+            self._image_variants = load_json_column(None if raw is _UNSET else raw, {})
+        return self._image_variants
+
+
+class User(Record):
+    __slots__ = ('id', 'username', 'email', 'password_hash', 'channel', 'created_at', 'bio', 'profile_pic',
+                 'followers_count', 'following_count', 'posts_count', 'security_question', 'security_answer')
+    exported = ('id', 'username', 'channel', 'created_at', 'bio', 'profile_pic',
+                'followers_count', 'following_count', 'posts_count')
+
+
+class Comment(Record):
+    __slots__ = ('id', 'blog_id', 'username', 'text', 'created_at')
+    aliases = {'comment_text': 'text'}
+
+
+class Notification(Record):
+    __slots__ = ('id', 'user_username', 'from_username', 'type', 'message', 'blog_id', 'is_read', 'created_at')
@@ -0,0 +1,79 @@
+import hashlib
+import time
+from functools import wraps
+
+from flask import request, session, make_response
+
+
+class PageCache:
+    """Full-page cache for anonymous GET requests.
+
+    Each cached page depends on a set of tags (e.g. 'feed', 'blog:5'). Every
+    tag has a generation stored in the cache; invalidating a tag gives it a
+    new generation, which changes the key of every page that depends on it.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _generation(self, tag):
+        key = f'tag:{tag}'
+        generation = self.cache.get(key)
+        if generation is None:
+            # A missing (or evicted) tag starts a fresh generation so pages
+            # cached under an older one can never match again
+            generation = time.time_ns()
+            self.cache.set(key, generation, ttl=0)
+        return generation
+
+    def invalidate(self, *tags):
+        """Expire every cached page that depends on any of the given tags"""
+        if self.cache is None:
+            return
+        for tag in tags:
+            self.cache.set(f'tag:{tag}', time.time_ns(), ttl=0)
+
+    def _page_key(self, tags):
+        generations = '|'.join(f'{tag}={self._generation(tag)}' for tag in tags)
+        return f'page:{request.url}|{generations}'
+
+    def _is_cacheable_request(self):
+        return (request.method == 'GET'
+                and 'username' not in session
+                and not session.get('_flashes'))
+
+    def cached(self, tags_for):
+        """Decorate a view whose anonymous output depends on tags_for(**view_args)"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if self.cache is None or not self._is_cacheable_request():
+                    return view(*args, **kwargs)
+
+                key = self._page_key(tags_for(**kwargs))
+                entry = self.cache.get(key)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    # Only plain successful renders that left the session alone
+                    if (response.status_code != 200 or session.modified
+                            or response.mimetype != 'text/html'):
+                        return response
+                    body = response.get_data()
+                    entry = {
+                        'body': body,
+                        'content_type': response.content_type,
+                        'etag': hashlib.sha1(body).hexdigest(),
+                        'last_modified': time.time(),
+                    }
+                    self.cache.set(key, entry)
+                else:
+                    response = make_response(entry['body'])
+                    response.content_type = entry['content_type']
+
+                response.set_etag(entry['etag'])
+                response.last_modified = entry['last_modified']
+                response.headers['Cache-Control'] = 'public, no-cache'
+                response.vary.add('Cookie')
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
@@ -0,0 +1,93 @@
+"""Storage for password reset tokens.
+
+Only the SHA-256 digest of a token is stored (see hashing.token_digest) and
+it is indexed, so checking a token is one index lookup however many are
+outstanding. The itsdangerous signature on the token itself provides
+integrity and the age limit; the row provides single use.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from hashing import token_digest
+
+RESET_TOKEN_MINUTES = 30
+# Expired rows are deleted every this many seconds
+RESET_TOKEN_SWEEP_INTERVAL = int(os.environ.get('RESET_TOKEN_SWEEP_INTERVAL', 3600))
+
+
+def utc_timestamp(delta=timedelta()):
+    """UTC time as text in the same form as CURRENT_TIMESTAMP"""
+    return (datetime.now(timezone.utc) + delta).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def store_reset_token(cursor, username, token):
+    """Record a new token for username, retiring any earlier unused ones"""
+    now = utc_timestamp()
+    cursor.execute('UPDATE password_reset_tokens SET used_at = ? WHERE username = ? AND used_at IS NULL',
+                   (now, username))
+    cursor.execute('''
+        INSERT INTO password_reset_tokens (username, token_hash, created_at, expires_at)
+        VALUES (?, ?, ?, ?)
+    ''', (username, token_digest(token), now, utc_timestamp(timedelta(minutes=RESET_TOKEN_MINUTES))))
+
+
+def find_reset_token(cursor, username, token):
+    """True if token is an unused, unexpired token issued to username"""
+    cursor.execute('''
+        SELECT 1 FROM password_reset_tokens
+        WHERE token_hash = ? AND username = ? AND used_at IS NULL AND expires_at > ?
+    ''', (token_digest(token), username, utc_timestamp()))
+    return cursor.fetchone() is not None
+
+
+def consume_reset_token_row(cursor, username, token):
+    """Mark the token used in one statement; True only for the first caller"""
+    cursor.execute('''
+        UPDATE password_reset_tokens SET used_at = ?
+        WHERE token_hash = ? AND username = ? AND used_at IS NULL AND expires_at > ?
+        RETURNING id
+    ''', (utc_timestamp(), token_digest(token), username, utc_timestamp()))
+    return cursor.fetchone() is not None
+
+
+def delete_expired_reset_tokens(cursor):
+    """Remove expired rows - used tokens expire too, so this clears them all"""
+    cursor.execute('DELETE FROM password_reset_tokens WHERE expires_at <= ?', (utc_timestamp(),))
+    return cursor.rowcount
+
+
+class ResetTokenSweeper:
+    """Daemon thread deleting expired reset tokens every interval seconds"""
+
+    def __init__(self, connection_factory, interval=RESET_TOKEN_SWEEP_INTERVAL):
+        # connection_factory is a context manager factory like ConnectionPool.connection
+        self.connection_factory = connection_factory
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the sweeper thread in this process"""
+        if self.interval <= 0:
+            return
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='reset-token-sweeper', daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        try:
+            with self.connection_factory() as conn:
+                deleted = delete_expired_reset_tokens(conn.cursor())
+            if deleted:
+                print(f"Deleted {deleted} expired password reset tokens")
+            return deleted
+        except Exception as e:
+            print(f"Error sweeping reset tokens: {e}")
+            return 0
+
+    def stop(self):
+        self._stop.set()
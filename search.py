@@ -0,0 +1,140 @@
+import re
+import sqlite3
+
+from markupsafe import Markup, escape
+
+from models import Blog
+
+# Snippet highlight markers - control characters that cannot appear in
+# sanitized blog text, swapped for <mark> tags after HTML escaping
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+SEARCH_RESULT_LIMIT = 50
+
+# Columns returned by search_blogs(), matching the home feed query plus the
+# highlighted snippet
+_SQLITE_SEARCH_QUERY = f'''
+    SELECT b.id, b.title, substr(b.content, 1, 201) AS content, b.author_username, b.channel, b.created_at, b.images,
+           b.likes_count, b.comments_count, b.image_variants,
+           snippet(blogs_fts, 1, '{_MARK_START}', '{_MARK_END}', '...', 32) AS snippet
+    FROM blogs_fts
+    JOIN blogs b ON b.id = blogs_fts.rowid
+    WHERE blogs_fts MATCH ?
+    ORDER BY bm25(blogs_fts, 10.0, 1.0, 5.0)
+    LIMIT ?
+'''
+
+_POSTGRES_SEARCH_QUERY = f'''
+    SELECT b.id, b.title, substr(b.content, 1, 201) AS content, b.author_username, b.channel, b.created_at, b.images,
+           b.likes_count, b.comments_count, b.image_variants,
+           ts_headline('english', b.content, q,
+                       'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords=35, MinWords=15') AS snippet
+    FROM blogs b, to_tsquery('english', %s) q
+    WHERE b.search_vector @@ q
+    ORDER BY ts_rank(b.search_vector, q) DESC
+    LIMIT %s
+'''
+
+# Fallback when SQLite was built without FTS5: still a scan, but in SQL
+_LIKE_SEARCH_QUERY = '''
+    SELECT b.id, b.title, substr(b.content, 1, 201) AS content, b.author_username, b.channel, b.created_at, b.images,
+           b.likes_count, b.comments_count, b.image_variants,
+           NULL AS snippet
+    FROM blogs b
+    WHERE b.title LIKE ? ESCAPE '\\' OR b.content LIKE ? ESCAPE '\\' OR b.author_username LIKE ? ESCAPE '\\'
+    ORDER BY b.created_at DESC
+    LIMIT ?
+'''
+
+_fts_available = None
+
+
+def init_search_index(conn, backend):
+    """Create the full-text index for blogs, populating it on first creation"""
+    global _fts_available
+    cursor = conn.cursor()
+
+    if backend == 'postgresql':
+        cursor.execute('''
+            ALTER TABLE blogs ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(author_username, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(content, '')), 'C')
+            ) STORED
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_blogs_search ON blogs USING GIN (search_vector)')
+        _fts_available = True
+        return
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blogs_fts'")
+    exists = cursor.fetchone() is not None
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS blogs_fts USING fts5(
+                title, content, author_username,
+                content='blogs', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, search falls back to LIKE: {e}")
+        _fts_available = False
+        return
+
+    if not exists:
+        cursor.execute("INSERT INTO blogs_fts(blogs_fts) VALUES ('rebuild')")
+    _fts_available = True
+
+
+def index_blog(conn, backend, blog_id):
+    """Add a blog's current title/content/author to the search index"""
+    if backend != 'sqlite' or not _fts_available:
+        return
+    conn.execute('''
+        INSERT INTO blogs_fts(rowid, title, content, author_username)
+        SELECT id, title, content, author_username FROM blogs WHERE id = ?
+    ''', (blog_id,))
+
+
+def unindex_blog(conn, backend, blog_id):
+    """Remove a blog from the search index - call before the row changes"""
+    if backend != 'sqlite' or not _fts_available:
+        return
+    conn.execute('''
+        INSERT INTO blogs_fts(blogs_fts, rowid, title, content, author_username)
+        SELECT 'delete', id, title, content, author_username FROM blogs WHERE id = ?
+    ''', (blog_id,))
+
+
+def _query_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def search_blogs(conn, backend, query, limit=SEARCH_RESULT_LIMIT):
+    """Return ranked Blog records matching every term of query as a prefix"""
+    terms = _query_terms(query)
+    if not terms:
+        return []
+
+    cursor = conn.cursor()
+    if backend == 'postgresql':
+        cursor.execute(_POSTGRES_SEARCH_QUERY, (' & '.join(f'{term}:*' for term in terms), limit))
+    elif _fts_available:
+        cursor.execute(_SQLITE_SEARCH_QUERY, (' '.join(f'"{term}"*' for term in terms), limit))
+    else:
+        # User input is matched literally, not as LIKE wildcards
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = f'%{escaped}%'
+        cursor.execute(_LIKE_SEARCH_QUERY, (pattern, pattern, pattern, limit))
+    return Blog.fetch_all(cursor)
+
+
+def highlight_snippet(snippet):
+    """HTML-escape a search snippet and turn its match markers into <mark> tags"""
+    if not snippet:
+        return None
+    html = str(escape(snippet))
+    return Markup(html.replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>'))
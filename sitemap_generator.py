@@ -1,68 +1,173 @@
-from flask import make_response
-import sqlite3
-from datetime import datetime
+import os
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from flask import send_file, abort
+
+from database import streaming_cursor
+
+SITEMAP_BASE_URL = os.environ.get('SITEMAP_BASE_URL', 'https://my-blog-app-utli.onrender.com')
+
+# Blog ids are sharded into fixed ranges so a write only touches one file.
+# The protocol allows 50,000 URLs per file; shard 0 also carries the static
+# pages, so leave some headroom.
+BLOGS_PER_SHARD = 45000
+
+STATIC_PAGES = [
+    ('/', 'daily', '1.0'),
+    ('/login', 'monthly', '0.5'),
+    ('/register', 'monthly', '0.5'),
+]
+
+
+class SitemapBuilder:
+    """Builds sitemap files on disk and rebuilds only the shards that changed.
+
+    Writes touch a per-shard ".dirty" marker. A shard file is fresh while its
+    mtime (set to when its build *started*) is newer than the marker, so a
+    write that lands mid-build still forces another rebuild.
+    """
+
+    def __init__(self, directory, connection, backend='sqlite', base_url=SITEMAP_BASE_URL):
+        self.directory = os.path.abspath(directory)
+        self.connection = connection
+        self.backend = backend
+        self.base_url = base_url.rstrip('/')
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _touch(self, name):
+        with open(self._path(name), 'a'):
+            pass
+        os.utime(self._path(name))
+
+    def _is_fresh(self, name):
+        try:
+            built = os.stat(self._path(name)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        try:
+            dirty = os.stat(self._path(name + '.dirty')).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return built > dirty
+
+    def _write(self, name, started_ns, chunks):
+        """Stream chunks into name atomically, stamped with the build start time"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.utime(tmp_path, ns=(started_ns, started_ns))
+            os.replace(tmp_path, self._path(name))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def mark_dirty(self, blog_id):
+        """Record that a blog was created, edited or deleted"""
+        try:
+            self._touch(f'sitemap-{blog_id // BLOGS_PER_SHARD}.xml.dirty')
+            self._touch('sitemap.xml.dirty')
+        except OSError as e:
+            print(f"Error marking sitemap dirty: {e}")
+
+    def shard_count(self):
+        """Number of shards needed to cover every blog id"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(id) FROM blogs')
+            max_id = cursor.fetchone()[0] or 0
+        return max_id // BLOGS_PER_SHARD + 1
+
+    def _url(self, loc, lastmod=None, changefreq=None, priority=None):
+        parts = [f'  <url>\n    <loc>{escape(loc)}</loc>\n']
+        if lastmod:
+            parts.append(f'    <lastmod>{lastmod}</lastmod>\n')
+        if changefreq:
+            parts.append(f'    <changefreq>{changefreq}</changefreq>\n')
+        if priority:
+            parts.append(f'    <priority>{priority}</priority>\n')
+        parts.append('  </url>\n')
+        return ''.join(parts)
+
+    def _shard_chunks(self, shard):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        if shard == 0:
+            for path, changefreq, priority in STATIC_PAGES:
+                yield self._url(f'{self.base_url}{path}', changefreq=changefreq, priority=priority)
+
+        with self.connection() as conn:
+            # Server-side cursor on PostgreSQL - a shard is up to 45,000 rows
+            cursor = streaming_cursor(conn, self.backend, f'sitemap_shard_{shard}')
+            cursor.execute('''
+                SELECT id, COALESCE(updated_at, created_at) FROM blogs
+                WHERE id >= ? AND id < ?
+                ORDER BY id
+            ''', (shard * BLOGS_PER_SHARD, (shard + 1) * BLOGS_PER_SHARD))
+            for blog_id, modified_at in cursor:
+                lastmod = str(modified_at)[:10] if modified_at else None
+                yield self._url(f'{self.base_url}/blog/{blog_id}', lastmod, 'weekly', '0.8')
+        yield '</urlset>\n'
+
+    def _index_chunks(self, shard_count):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for shard in range(shard_count):
+            yield f'  <sitemap>\n    <loc>{escape(self.base_url)}/sitemap-{shard}.xml</loc>\n  </sitemap>\n'
+        yield '</sitemapindex>\n'
+
+    def shard_file(self, shard):
+        """Return the path of an up-to-date shard file"""
+        name = f'sitemap-{shard}.xml'
+        with self._lock:
+            if not self._is_fresh(name):
+                started_ns = time.time_ns()
+                self._write(name, started_ns, self._shard_chunks(shard))
+        return self._path(name)
+
+    def index_file(self):
+        """Return sitemap.xml - a plain urlset until a second shard is needed"""
+        name = 'sitemap.xml'
+        with self._lock:
+            if not self._is_fresh(name):
+                started_ns = time.time_ns()
+                shard_count = self.shard_count()
+                if shard_count == 1:
+                    chunks = self._shard_chunks(0)
+                else:
+                    chunks = self._index_chunks(shard_count)
+                self._write(name, started_ns, chunks)
+        return self._path(name)
+
+
+def generate_sitemap(app, builder):
+    """Register the sitemap routes, served from the builder's files"""
 
-def generate_sitemap(app):
-    """Generate XML sitemap for all blog posts"""
-    
     @app.route('/sitemap.xml')
     def sitemap():
-        pages = []
-        
-        # Add static pages
-        pages.append({
-            'loc': 'https://my-blog-app-utli.onrender.com/',
-            'lastmod': datetime.now().strftime('%Y-%m-%d'),
-            'changefreq': 'daily',
-            'priority': '1.0'
-        })
-        
-        pages.append({
-            'loc': 'https://my-blog-app-utli.onrender.com/login',
-            'lastmod': datetime.now().strftime('%Y-%m-%d'),
-            'changefreq': 'monthly',
-            'priority': '0.5'
-        })
-        
-        pages.append({
-            'loc': 'https://my-blog-app-utli.onrender.com/register',
-            'lastmod': datetime.now().strftime('%Y-%m-%d'),
-            'changefreq': 'monthly',
-            'priority': '0.5'
-        })
-        
-        # Add all blog posts
         try:
-            with sqlite3.connect('blog_app.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT id, created_at FROM blogs ORDER BY created_at DESC')
-                blogs = cursor.fetchall()
-                
-                for blog in blogs:
-                    blog_id, created_at = blog
-                    pages.append({
-                        'loc': f'https://my-blog-app-utli.onrender.com/blog/{blog_id}',
-                        'lastmod': created_at.split()[0] if created_at else datetime.now().strftime('%Y-%m-%d'),
-                        'changefreq': 'weekly',
-                        'priority': '0.8'
-                    })
+            path = builder.index_file()
         except Exception as e:
             print(f"Error generating sitemap: {e}")
-        
-        # Generate XML
-        sitemap_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        sitemap_xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-        
-        for page in pages:
-            sitemap_xml += '  <url>\n'
-            sitemap_xml += f'    <loc>{page["loc"]}</loc>\n'
-            sitemap_xml += f'    <lastmod>{page["lastmod"]}</lastmod>\n'
-            sitemap_xml += f'    <changefreq>{page["changefreq"]}</changefreq>\n'
-            sitemap_xml += f'    <priority>{page["priority"]}</priority>\n'
-            sitemap_xml += '  </url>\n'
-        
-        sitemap_xml += '</urlset>'
-        
-        response = make_response(sitemap_xml)
-        response.headers['Content-Type'] = 'application/xml'
-        return response
+            abort(503)
+        return send_file(path, mimetype='application/xml', conditional=True, max_age=3600)
+
+    @app.route('/sitemap-<int:shard>.xml')
+    def sitemap_shard(shard):
+        if shard >= builder.shard_count():
+            abort(404)
+        try:
+            path = builder.shard_file(shard)
+        except Exception as e:
+            print(f"Error generating sitemap shard {shard}: {e}")
+            abort(503)
+        return send_file(path, mimetype='application/xml', conditional=True, max_age=3600)
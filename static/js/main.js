@@ -206,4 +206,58 @@ function removeImage(index) {
     } catch (err) {
         console.error('Error removing image:', err);
     }
-}
\ No newline at end of file
+}
+// Live updates - the notification badge, like counts and new messages are
+// pushed over Server-Sent Events instead of being polled
+function setNotificationBadge(link, count) {
+    let badge = link.querySelector('.notification-badge');
+    if (!badge) {
+        badge = document.createElement('span');
+        badge.className = 'notification-badge';
+        link.appendChild(badge);
+    }
+    badge.textContent = count;
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const notificationLink = document.querySelector('.notification-link');
+    // Only logged-in pages have the notification link
+    if (!notificationLink || !window.EventSource) return;
+    openLiveStream(notificationLink);
+});
+
+function openLiveStream(notificationLink) {
+    const stream = new EventSource('/api/stream');
+    
+    // A refused stream (the worker is at its stream limit) is closed for
+    // good by the browser; try again later, spread out so refused tabs do
+    // not all come back at once
+    stream.addEventListener('error', function() {
+        if (stream.readyState === EventSource.CLOSED) {
+            setTimeout(() => openLiveStream(notificationLink), 30000 + Math.random() * 60000);
+        }
+    });
+    
+    stream.addEventListener('notification', function() {
+        const badge = notificationLink.querySelector('.notification-badge');
+        setNotificationBadge(notificationLink, (badge ? parseInt(badge.textContent, 10) || 0 : 0) + 1);
+    });
+    
+    stream.addEventListener('likes', function(event) {
+        const counts = JSON.parse(event.data);
+        Object.keys(counts).forEach(blogId => {
+            document.querySelectorAll(`[data-blog-id="${blogId}"] .like-count, [data-blog-id="${blogId}"] .like-count-detail`)
+                .forEach(el => { el.textContent = counts[blogId]; });
+        });
+    });
+    
+    stream.addEventListener('message', function(event) {
+        const message = JSON.parse(event.data);
+        const inboxLink = document.querySelector('a[href="/messages"]');
+        if (inboxLink) setNotificationBadge(inboxLink, '•');
+        // An open thread with the sender just reloads to show the message
+        if (window.location.pathname === `/messages/${encodeURIComponent(message.from)}`) {
+            window.location.reload();
+        }
+    });
+}
@@ -0,0 +1,266 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Authors with more followers than this are not fanned out on write - their
+# posts are merged into followers' timelines at read time instead, so one
+# post never turns into an unbounded number of timeline rows
+TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+
+# Recent posts copied into a timeline when someone follows an author
+TIMELINE_BACKFILL = 50
+
+# Followers written per transaction when fanning out in the background
+TIMELINE_FANOUT_CHUNK = 1000
+
+# Timeline rows kept per user; older ones are trimmed every
+# TIMELINE_TRIM_INTERVAL seconds (0 disables the sweep)
+TIMELINE_MAX_ROWS = int(os.environ.get('TIMELINE_MAX_ROWS', 1000))
+TIMELINE_TRIM_INTERVAL = int(os.environ.get('TIMELINE_TRIM_INTERVAL', 3600))
+
+
+def add_to_author_timeline(cursor, blog_id):
+    """Add a new blog to its author's own timeline"""
+    cursor.execute('''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT author_username, id, author_username, created_at FROM blogs WHERE id = ?
+        ON CONFLICT (username, blog_id) DO NOTHING
+    ''', (blog_id,))
+
+
+def _follower_chunk(cursor, author, after):
+    """Return the last username of the next chunk of author's followers, or None"""
+    cursor.execute('''
+        SELECT follower_username FROM follows
+        WHERE following_username = ? AND follower_username > ?
+        ORDER BY follower_username
+        LIMIT 1 OFFSET ?
+    ''', (author, after, TIMELINE_FANOUT_CHUNK - 1))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    cursor.execute('''
+        SELECT MAX(follower_username) FROM follows
+        WHERE following_username = ? AND follower_username > ?
+    ''', (author, after))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def fan_out_chunk(cursor, blog_id, author, after):
+    """Copy a blog into the timelines of the next chunk of its author's followers.
+
+    Returns the last follower written, to pass as after for the next chunk,
+    or None once every follower has it.
+    """
+    last = _follower_chunk(cursor, author, after)
+    if last is None:
+        return None
+    cursor.execute('''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT f.follower_username, b.id, b.author_username, b.created_at
+        FROM blogs b
+        JOIN follows f ON f.following_username = b.author_username
+        WHERE b.id = ? AND f.follower_username > ? AND f.follower_username <= ?
+        ON CONFLICT (username, blog_id) DO NOTHING
+    ''', (blog_id, after, last))
+    return last
+
+
+def backfill_followers_chunk(cursor, author, after):
+    """Copy an author's recent posts into the next chunk of followers' timelines.
+
+    Used when an author drops back to TIMELINE_FANOUT_LIMIT followers: posts
+    written while above it were only merged in at read time. Returns the last
+    follower written, or None once every follower has them.
+    """
+    last = _follower_chunk(cursor, author, after)
+    if last is None:
+        return None
+    cursor.execute('''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT f.follower_username, b.id, b.author_username, b.created_at
+        FROM follows f
+        CROSS JOIN (
+            SELECT id, author_username, created_at FROM blogs
+            WHERE author_username = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ) b
+        WHERE f.following_username = ? AND f.follower_username > ? AND f.follower_username <= ?
+        ON CONFLICT (username, blog_id) DO NOTHING
+    ''', (author, TIMELINE_BACKFILL, author, after, last))
+    return last
+
+
+def trim_timelines(cursor, max_rows=TIMELINE_MAX_ROWS):
+    """Delete all but the newest max_rows entries of every timeline"""
+    cursor.execute('''
+        SELECT username FROM timeline GROUP BY username HAVING COUNT(*) > ?
+    ''', (max_rows,))
+    deleted = 0
+    for (username,) in cursor.fetchall():
+        # Everything older than the user's max_rows-th newest entry
+        cursor.execute('''
+            DELETE FROM timeline
+            WHERE username = ? AND (created_at, blog_id) < (
+                SELECT created_at, blog_id FROM timeline WHERE username = ?
+                ORDER BY created_at DESC, blog_id DESC
+                LIMIT 1 OFFSET ?
+            )
+        ''', (username, username, max_rows - 1))
+        deleted += cursor.rowcount
+    return deleted
+
+
+def backfill_timeline(cursor, follower, author):
+    """Copy an author's recent posts into a new follower's timeline"""
+    cursor.execute('''
+        INSERT INTO timeline (username, blog_id, author_username, created_at)
+        SELECT ?, id, author_username, created_at FROM blogs
+        WHERE author_username = ?
+        ORDER BY created_at DESC
+        LIMIT ?
+        ON CONFLICT (username, blog_id) DO NOTHING
+    ''', (follower, author, TIMELINE_BACKFILL))
+
+
+def remove_author_from_timeline(cursor, follower, author):
+    """Drop an author's posts from a timeline after an unfollow"""
+    cursor.execute('DELETE FROM timeline WHERE username = ? AND author_username = ?', (follower, author))
+
+
+def remove_blog_from_timelines(cursor, blog_id):
+    """Drop a deleted blog from every timeline"""
+    cursor.execute('DELETE FROM timeline WHERE blog_id = ?', (blog_id,))
+
+
+def _keyset(created_column, id_column, position, params):
+    """SQL condition selecting rows after a (created_at, id) keyset position"""
+    if not position:
+        return ''
+    params.extend(position)
+    # Row-value comparison, so the index is searched from the position
+    # rather than scanned down to it from the newest entry
+    return f' AND ({created_column}, {id_column}) < (?, ?)'
+
+
+def timeline_page_ids(cursor, username, position, limit):
+    """Return up to limit + 1 (created_at, blog_id) pairs, newest first.
+
+    Merges the materialized timeline with a read-time query over the
+    high-follower authors the user follows. position is a (created_at, id)
+    keyset from the previous page, or None.
+    """
+    params = [username]
+    query = 'SELECT t.created_at, t.blog_id FROM timeline t WHERE t.username = ?'
+    query += _keyset('t.created_at', 't.blog_id', position, params)
+    query += ' ORDER BY t.created_at DESC, t.blog_id DESC LIMIT ?'
+    params.append(limit + 1)
+    cursor.execute(query, params)
+    entries = [(row[0], row[1]) for row in cursor.fetchall()]
+
+    params = [username, TIMELINE_FANOUT_LIMIT]
+    query = '''
+        SELECT b.created_at, b.id
+        FROM follows f
+        JOIN users u ON u.username = f.following_username
+        JOIN blogs b ON b.author_username = f.following_username
+        WHERE f.follower_username = ? AND u.followers_count > ?
+    '''
+    query += _keyset('b.created_at', 'b.id', position, params)
+    query += ' ORDER BY b.created_at DESC, b.id DESC LIMIT ?'
+    params.append(limit + 1)
+    cursor.execute(query, params)
+    entries.extend((row[0], row[1]) for row in cursor.fetchall())
+
+    # Posts backfilled before an author crossed the limit appear in both
+    unique = {blog_id: created_at for created_at, blog_id in entries}
+    merged = sorted(((created_at, blog_id) for blog_id, created_at in unique.items()), reverse=True)
+    return merged[:limit + 1]
+
+
+class TimelineWorker:
+    """Fans new posts out to followers and trims timelines off the request path.
+
+    Fan-out runs on one background thread in chunks of TIMELINE_FANOUT_CHUNK
+    followers, each in its own transaction, so a popular author's post never
+    holds up the transaction that created it. A daemon thread trims every
+    timeline to TIMELINE_MAX_ROWS entries every trim_interval seconds.
+    """
+
+    def __init__(self, connection_factory, trim_interval=TIMELINE_TRIM_INTERVAL):
+        # connection_factory is a context manager factory like ConnectionPool.connection
+        self.connection_factory = connection_factory
+        self.trim_interval = trim_interval
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='timeline')
+            return self._executor
+
+    def fan_out(self, blog_id, author):
+        """Queue copying a new blog into its author's followers' timelines"""
+        return self._get_executor().submit(self._fan_out, blog_id, author)
+
+    def _fan_out(self, blog_id, author):
+        try:
+            with self.connection_factory() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT followers_count FROM users WHERE username = ?', (author,))
+                row = cursor.fetchone()
+        except Exception as e:
+            print(f"Error fanning out blog {blog_id}: {e}")
+            return
+        # Popular authors are merged in at read time instead
+        if row and row[0] <= TIMELINE_FANOUT_LIMIT:
+            self._run_chunks(fan_out_chunk, blog_id, author)
+
+    def backfill_followers(self, author):
+        """Queue copying an author's recent posts into every follower's timeline"""
+        return self._get_executor().submit(self._run_chunks, backfill_followers_chunk, author)
+
+    def _run_chunks(self, chunk, *args):
+        after = ''
+        try:
+            while after is not None:
+                with self.connection_factory() as conn:
+                    after = chunk(conn.cursor(), *args, after)
+                    conn.commit()
+        except Exception as e:
+            print(f"Error updating follower timelines ({chunk.__name__}{args}): {e}")
+
+    def start(self):
+        """Start the trim thread in this process"""
+        if self.trim_interval <= 0:
+            return
+        self._stop = threading.Event()
+        threading.Thread(target=self._run_trim, name='timeline-trim', daemon=True).start()
+
+    def _run_trim(self):
+        while not self._stop.wait(self.trim_interval):
+            self.trim()
+
+    def trim(self):
+        try:
+            with self.connection_factory() as conn:
+                deleted = trim_timelines(conn.cursor())
+                conn.commit()
+            if deleted:
+                print(f"Trimmed {deleted} old timeline entries")
+            return deleted
+        except Exception as e:
+            print(f"Error trimming timelines: {e}")
+            return 0
+
+    def reset_after_fork(self):
+        """Drop the executor inherited from the parent - its thread did not survive"""
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self._stop.set()
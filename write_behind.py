@@ -0,0 +1,266 @@
+import atexit
+import os
+import threading
+
+# Seconds between flushes; 0 writes through on every call
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 1.0))
+# Flush early once this many writes are waiting
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 500))
+# Refuse new writes (WriteBehindFull) once this many are held
+WRITE_BEHIND_MAX_BUFFER = int(os.environ.get('WRITE_BEHIND_MAX_BUFFER', 10000))
+# Failed batch flushes before the writes are retried one at a time and the
+# ones that still fail are dropped
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get('WRITE_BEHIND_MAX_RETRIES', 3))
+# Longest wait between flush attempts while they keep failing
+WRITE_BEHIND_MAX_BACKOFF = 30.0
+
+_INSERT_LIKE = '''
+    INSERT INTO likes (blog_id, username)
+    SELECT ?, ? WHERE EXISTS (SELECT 1 FROM blogs WHERE id = ?)
+    ON CONFLICT (blog_id, username) DO NOTHING
+'''
+
+_DELETE_LIKE = 'DELETE FROM likes WHERE blog_id = ? AND username = ?'
+
+_RECOUNT_LIKES = '''
+    UPDATE blogs SET likes_count = (SELECT COUNT(*) FROM likes l WHERE l.blog_id = blogs.id)
+    WHERE id = ?
+'''
+
+# Built in SQL so a click never has to look up the blog's author and title
+_INSERT_LIKE_NOTIFICATION = '''
+    INSERT INTO notifications (user_username, from_username, type, message, blog_id)
+    SELECT author_username, ?, 'like', ? || ' liked your blog "' || substr(title, 1, 30) || '..."', id
+    FROM blogs WHERE id = ? AND author_username != ?
+'''
+
+# Skips notifications about a blog deleted while they were queued
+_INSERT_NOTIFICATION = '''
+    INSERT INTO notifications (user_username, from_username, type, message, blog_id)
+    SELECT ?, ?, ?, ?, ? WHERE ? IS NULL OR EXISTS (SELECT 1 FROM blogs WHERE id = ?)
+'''
+
+
+class WriteBehindFull(Exception):
+    """Raised when the buffer already holds WRITE_BEHIND_MAX_BUFFER writes"""
+
+
+class WriteBehindBuffer:
+    """Coalesces like toggles and notification inserts into batched writes.
+
+    Likes are kept as the latest desired state per (blog_id, username), so a
+    like/unlike/like burst costs a single row write. A background thread
+    flushes everything in one transaction every WRITE_BEHIND_INTERVAL
+    seconds. Pending state is per process: callers read it back through
+    pending_like() to see their own writes before they are flushed.
+
+    A failed flush is retried with exponential backoff. After max_retries
+    failures in a row each write gets its own transaction, so one bad row
+    cannot hold up the rest; writes that still fail are logged and dropped.
+    """
+
+    def __init__(self, connection, on_flush=None, interval=WRITE_BEHIND_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING, max_buffer=WRITE_BEHIND_MAX_BUFFER,
+                 max_retries=WRITE_BEHIND_MAX_RETRIES):
+        self.connection = connection
+        self.on_flush = on_flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self._likes = {}
+        self._notifications = []
+        self._failures = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+        atexit.register(self.shutdown)
+
+    def set_like(self, blog_id, username, liked):
+        """Queue a like (liked=True) or unlike of blog_id by username"""
+        with self._lock:
+            key = (blog_id, username)
+            if key not in self._likes:
+                self._check_capacity()
+            self._likes[key] = liked
+        self._queued()
+
+    def pending_like(self, blog_id, username):
+        """Queued like state for this user - True, False or None if nothing is queued"""
+        with self._lock:
+            return self._likes.get((blog_id, username))
+
+    def add_notification(self, user_username, from_username, type, message, blog_id=None):
+        """Queue a notification insert"""
+        with self._lock:
+            self._check_capacity()
+            self._notifications.append((user_username, from_username, type, message, blog_id))
+        self._queued()
+
+    def _pending_count(self):
+        return len(self._likes) + len(self._notifications)
+
+    def _check_capacity(self):
+        # A batch being flushed still counts: it comes back if the flush fails
+        if self._pending_count() + self._in_flight >= self.max_buffer:
+            raise WriteBehindFull(f"Write-behind buffer is full ({self.max_buffer} writes waiting)")
+
+    def _queued(self):
+        if self.interval <= 0:
+            self.flush()
+            return
+        self._ensure_thread()
+        # While flushes are failing, wait out the backoff instead
+        if self._pending_count() >= self.max_pending and not self._failures:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self._delay())
+            self._wakeup.clear()
+            self.flush()
+
+    def _delay(self):
+        if not self._failures:
+            return self.interval
+        return min(self.interval * 2 ** self._failures, WRITE_BEHIND_MAX_BACKOFF)
+
+    def flush(self):
+        """Write everything queued so far in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                likes, self._likes = self._likes, {}
+                notifications, self._notifications = self._notifications, []
+                self._in_flight = len(likes) + len(notifications)
+            if not likes and not notifications:
+                return True
+
+            try:
+                recipients, written = self._write(likes, notifications)
+            except Exception as e:
+                self._failures += 1
+                if self._failures < self.max_retries:
+                    print(f"Error flushing write-behind buffer (attempt {self._failures}): {e}")
+                    self._requeue(likes, notifications)
+                    return False
+                print(f"Error flushing write-behind buffer (attempt {self._failures}), "
+                      f"writing {len(likes) + len(notifications)} items one at a time: {e}")
+                recipients, written, failed_likes, failed_notifications = self._write_each(likes, notifications)
+                if len(failed_likes) + len(failed_notifications) == len(likes) + len(notifications):
+                    # Nothing could be written: the database is unavailable
+                    # rather than the data bad, so keep everything and back off
+                    self._requeue(likes, notifications)
+                    return False
+                for key, liked in failed_likes.items():
+                    print(f"Dropping write-behind {'like' if liked else 'unlike'} {key}")
+                for notification in failed_notifications:
+                    print(f"Dropping write-behind notification {notification}")
+            self._failures = 0
+            self._in_flight = 0
+
+            if self.on_flush:
+                try:
+                    self.on_flush({blog_id for blog_id, _ in likes}, recipients, written)
+                except Exception as e:
+                    print(f"Error in write-behind flush callback: {e}")
+            return True
+
+    def _write(self, likes, notifications):
+        added = [(blog_id, username) for (blog_id, username), liked in likes.items() if liked]
+        removed = [(blog_id, username) for (blog_id, username), liked in likes.items() if not liked]
+        blog_ids = sorted({blog_id for blog_id, _ in likes})
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # One row at a time: a like that already existed (liked again in
+            # another tab, or like/unlike/like across flushes) is skipped by
+            # ON CONFLICT and must not notify the author a second time
+            inserted = []
+            for blog_id, username in added:
+                cursor.execute(_INSERT_LIKE, (blog_id, username, blog_id))
+                if cursor.rowcount == 1:
+                    inserted.append((blog_id, username))
+            if inserted:
+                cursor.executemany(_INSERT_LIKE_NOTIFICATION, [(u, u, b, u) for b, u in inserted])
+            if removed:
+                cursor.executemany(_DELETE_LIKE, removed)
+            if blog_ids:
+                # Recount instead of adding deltas, which would also need the
+                # rows removed by each DELETE
+                cursor.executemany(_RECOUNT_LIKES, [(b,) for b in blog_ids])
+            # Every notification written, in add_notification() form, so the
+            # caller can push them to their recipients once committed
+            written = []
+            for notification in notifications:
+                cursor.execute(_INSERT_NOTIFICATION, notification + (notification[4], notification[4]))
+                if cursor.rowcount == 1:
+                    written.append(notification)
+
+            liked_blogs = sorted({b for b, _ in inserted})
+            if liked_blogs:
+                placeholders = ', '.join('?' for _ in liked_blogs)
+                cursor.execute(f'SELECT id, author_username, title FROM blogs WHERE id IN ({placeholders})',
+                               liked_blogs)
+                blogs = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+                for blog_id, username in inserted:
+                    author, title = blogs.get(blog_id, (None, None))
+                    if author is not None and author != username:
+                        written.append(
+                            (author, username, 'like', f'{username} liked your blog "{title[:30]}..."', blog_id))
+            conn.commit()
+        return {n[0] for n in written}, written
+
+    def _write_each(self, likes, notifications):
+        """Write every item in its own transaction; also returns the ones that failed"""
+        recipients, written = set(), []
+        failed_likes, failed_notifications = {}, []
+        items = [({key: liked}, []) for key, liked in likes.items()]
+        items += [({}, [notification]) for notification in notifications]
+        for item_likes, item_notifications in items:
+            try:
+                item_recipients, item_written = self._write(item_likes, item_notifications)
+            except Exception as e:
+                print(f"Error writing {item_likes or item_notifications}: {e}")
+                failed_likes.update(item_likes)
+                failed_notifications.extend(item_notifications)
+                continue
+            recipients |= item_recipients
+            written.extend(item_written)
+        return recipients, written, failed_likes, failed_notifications
+
+    def _requeue(self, likes, notifications):
+        with self._lock:
+            for key, liked in likes.items():
+                # A newer toggle queued during the failed flush wins
+                self._likes.setdefault(key, liked)
+            self._notifications[:0] = notifications
+            self._in_flight = 0
+
+    def reset_after_fork(self):
+        """Start the child empty - the parent flushes what it had queued"""
+        self._likes = {}
+        self._notifications = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._failures = 0
+        self._in_flight = 0
+
+    def shutdown(self):
+        """Stop the flush thread and write out anything still queued"""
+        self._stopping = True
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=self.interval + 5)
+        self.flush()